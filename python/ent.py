@@ -1,16 +1,29 @@
 #!/usr/bin/python3
 
 import argparse
+import logging
 import shlex
 import os, time
 import itertools
+import functools
+import heapq
+import collections
 import re
 import copy
 import sys
 import json
+import marshal
+import mmap
+import sqlite3
 import hashlib
+import zlib
+from stat import S_ISDIR
 import subprocess
-from pathlib import Path
+import socket
+import tempfile
+import threading
+import asyncio
+import concurrent.futures
 
 """
 Main Data Structures:
@@ -27,15 +40,62 @@ Main Data Structures:
 
 ## TODO handle quotes in variable definitions
 md5re = re.compile('([0-9]{32})  (.*)|md5sum: (.*)')
-gvarre = re.compile('(.*?)\${\s*([a-zA-Z0-9_.]+)\s*}(.*)')
 
-VERBOSE=10
+# Ways of fingerprinting files, see fingerprint()
+FINGERPRINTS = ('mtime', 'stat', 'md5', 'fast')
+HASHBLOCK = 1<<20
+
+# Default number of threads used by scan_files(), and the number of paths
+# from one directory above which the directory is listed rather than each
+# path stat'ed individually
+SCANTHREADS = 16
+SCANDIR_MIN = 8
+
+# Number of jobs expanded at a time in lazy mode
+LAZYBATCH = 1000
+# Jobs that are waiting, ready or running beyond which no more are expanded
+# in lazy mode (unless none of them can run)
+LAZYWINDOW = 10 * LAZYBATCH
+
+# Directory for files shared with jobs (task lists of array jobs, scripts of
+# chained commands)
+WORKDIR = '.ent'
+
+# Estimated seconds a job takes when neither its Generator nor the state
+# file has an estimate, used to order jobs by the length of the path after
+# them
+DEFAULTRUNTIME = 1
+
+# Seconds an asyncio runner waits in a blocking executor call at a time
+POLLTIME = 1
+
+# Environment variables grid engines use for the index of an array job task
+TASKID_VARS = ('SGE_TASK_ID', 'PBS_ARRAYID', 'PBS_ARRAY_INDEX',
+		'SLURM_ARRAY_TASK_ID', 'LSB_JOBINDEX')
+# Values of a variable that needs no unquoting (see split_values)
+valuere = re.compile('[^ \t\r\n]+')
+tokenre = re.compile('\${\s*([a-zA-Z0-9_.]+)\s*}')
+
+# Command templates: ${VAR}, $< or $>, ${<} or ${>} and ${<N} or ${>N}
+templatere = re.compile('\${\s*([a-zA-Z0-9_.]+)\s*}|\$([<>])|'
+		'\${\s*([<>])\s*([0-9]*)\s*}')
+
+# Maximum depth of variables referring to variables in commands
+MAXDEPTH = 100
+
+# Logging, at INFO ent reports progress, DEBUG adds every job submitted and
+# finished and TRACE everything parsed and expanded. Arguments are only
+# formatted if the level is enabled.
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+log = logging.getLogger('ent')
 
 decodestatus = {}
 
 def initdrmaa():
-		import drmaa
+		global drmaa
 		global decodestatus
+		import drmaa
 		decodestatus = {
 			drmaa.JobState.UNDETERMINED: 'process status cannot be determined',
 			drmaa.JobState.QUEUED_ACTIVE: 'job is queued and active',
@@ -51,38 +111,206 @@ def initdrmaa():
 
 def main():
 	parser = argparse.ArgumentParser(description='Run ENT on an ent script')
-	parser.add_argument('--script', '-f', type=str,
-			help='Input script file', required=True)
+	parser.add_argument('--script', '-f', type=str, action='append',
+			help='Input script file. Several may be given, to run them '
+			'together sharing --max-running')
 	parser.add_argument('--state', '-s', type=str, nargs=1,
-			default="", help='State file (to store md5 sums in')
+			default="", help='State file (to store md5 sums in). SQLite, '
+			'updated as each job finishes, unless the name ends in .json. '
+			'With several scripts, a directory to keep one for each in')
 	parser.add_argument('--simulate', '-x', action='store_const', const=True,
 			default="", help='Simulate running rather than actually running')
+	parser.add_argument('--fingerprint', type=str, default='mtime',
+			choices=FINGERPRINTS, help='How to detect changed files: '
+			'mtime (default), stat (mtime and size), md5 or fast (hash '
+			'of the contents)')
+	parser.add_argument('--hash-cache', type=str, default=None,
+			help='File to cache content hashes in (default: STATE.cache)')
+	parser.add_argument('--threads', type=int, default=None,
+			help='Number of threads used to fingerprint files (default: %i)'
+			% SCANTHREADS)
+	parser.add_argument('--lazy', action='store_true',
+			help='Expand jobs while running rather than all before starting')
+	parser.add_argument('--tree-cache', type=str, default=None,
+			metavar='DIR', help='Directory to keep the expanded tree in, so '
+			'that an unchanged script isn\'t parsed and expanded again '
+			'(default: STATE.trees, none without a state file)')
+	parser.add_argument('--no-tree-cache', action='store_true',
+			help='Always parse and expand the script')
+	parser.add_argument('--executor', '-e', type=str, default='drmaa',
+			choices=sorted(EXECUTORS), help='How to run commands')
+	parser.add_argument('--jobs', '-j', type=int, default=None,
+			help='Number of concurrent commands for the local executor '
+			'(default: number of cpus)')
+	parser.add_argument('--workdir', type=str, default=WORKDIR,
+			help='Directory for files shared with grid engine jobs, must be '
+			'visible to the execution hosts (default: %s)' % WORKDIR)
+	parser.add_argument('--no-bulk', action='store_true',
+			help='Submit each command as a separate grid engine job rather '
+			'than as array jobs')
+	parser.add_argument('--max-running', type=int, default=None,
+			help='Maximum number of jobs submitted at once (with '
+			'--simulate, the number to estimate the time to run with; with '
+			'several scripts, the number they share, by default -j for the '
+			'local executor)')
+	parser.add_argument('--chain', action='store_true',
+			help='Run all the commands of a job as one submission (a script '
+			'that stops at the first failure)')
+	parser.add_argument('--daemon', type=str, default=None, metavar='SOCKET',
+			help='Keep running once there is nothing left to do (failed '
+			'jobs may be retried) and take requests from --control through '
+			'a UNIX socket at SOCKET, until sent stop')
+	parser.add_argument('--control', type=str, nargs='+', default=None,
+			metavar='ARG', help='SOCKET COMMAND [VALUE]: send COMMAND '
+			'(status, pause, resume, limit, retry or stop) to the ent '
+			'running with --daemon SOCKET and print the reply')
+	parser.add_argument('--run-task', type=str, default=None,
+			help=argparse.SUPPRESS)
+	parser.add_argument('--verbose', '-v', action='count', default=0,
+			help='Log more (-v for every job, -vv for everything)')
+	parser.add_argument('--quiet', '-q', action='store_true',
+			help='Only log warnings and errors')
+	parser.add_argument('--trace', type=str, default=None,
+			help='Write the timings of the commands run to this file as '
+			'Chrome trace events (chrome://tracing or ui.perfetto.dev)')
+	parser.add_argument('--events', type=str, default=None,
+			help='Append job events (submitted/finished/failed) to this '
+			'file as JSON lines')
 
 	args = parser.parse_args()
 
+	if args.quiet:
+		level = logging.WARNING
+	else:
+		level = [logging.INFO, logging.DEBUG, TRACE][min(args.verbose, 2)]
+	logging.basicConfig(level=level,
+			format='%(asctime)s %(levelname)s %(message)s')
+
+	if args.run_task:
+		# running as one task of an array job
+		return run_task(args.run_task)
+	elif args.control:
+		if len(args.control) not in (2, 3):
+			parser.error("--control takes SOCKET COMMAND [VALUE]")
+		value = None
+		if len(args.control) == 3:
+			try:
+				value = json.loads(args.control[2])
+			except ValueError:
+				value = args.control[2]
+		try:
+			reply = control(*args.control[:2], value)
+		except OSError as e:
+			log.error("Error connecting to %s: %s", args.control[0], e)
+			return 1
+		print(json.dumps(reply, indent=1))
+		return 0 if reply.get('ok') else 1
+	elif not args.script:
+		parser.error("the following arguments are required: --script/-f")
+
+	# Several scripts are run together by a Master, each with a state file
+	# named after it in the state directory
+	scripts = args.script
+	if len(scripts) > 1:
+		names = [os.path.basename(script) for script in scripts]
+		if len(set(names)) < len(names):
+			parser.error("scripts run together must have different names")
+		if args.daemon:
+			parser.error("--daemon runs a single script")
+
 	if args.state:
 		statename = args.state[0]
 	else:
 		statename = None
 
-	entobj = Ent(args.script, statename)
+	if len(scripts) == 1:
+		statenames = [statename]
+	elif statename:
+		os.makedirs(statename, exist_ok=True)
+		statenames = [os.path.join(statename, os.path.basename(script) +
+			'.db') for script in scripts]
+	else:
+		statenames = [None for script in scripts]
+
+	cachename = args.hash_cache
+	if not cachename and statename:
+		cachename = statename + '.cache'
+	fpcache = FingerprintCache(cachename)
+
+	treecache = args.tree_cache
+	if not treecache and statename:
+		treecache = statename + '.trees'
+	if args.no_tree_cache:
+		treecache = None
+
+	events = None
+	if args.events:
+		events = EventLog(open(args.events, "a"))
+
+	# Files the trees share are only fingerprinted once
+	if len(scripts) > 1:
+		fpcache.known = dict()
+	ents = []
+	for script, name in zip(scripts, statenames):
+		entobj = Ent(script, name, args.fingerprint, fpcache,
+				args.threads, args.lazy and not args.simulate,
+				treecache,
+				bool(args.simulate))
+		if events:
+			entobj.events = events
+		entobj.workdir = args.workdir
+		ents.append(entobj)
+	fpcache.known = None
 
 	if args.simulate:
-		entobj.simulate()
+		for entobj in ents:
+			entobj.simulate(args.max_running)
 	else:
+		if args.executor == 'local':
+			executor = LocalExecutor(args.jobs)
+		elif args.executor == 'drmaa':
+			executor = DrmaaExecutor(args.workdir, not args.no_bulk)
+		else:
+			executor = EXECUTORS[args.executor]()
+
+		status = 0
 		try:
-			entobj.run()
-			initdrmaa()
+			if args.daemon:
+				asyncio.run(ents[0].serve(args.daemon, executor, args.chain,
+						args.max_running))
+			elif len(ents) > 1:
+				Master(ents).run(executor, args.chain, args.max_running)
+			else:
+				ents[0].run(executor, args.chain, args.max_running)
+		except InputError as e:
+			log.error("%s", e.msg)
+			status = 1
 		except:
-			e = sys.exc_info()[0]
-			print("Error: %s" % e )
+			log.exception("Error while running")
+			status = 1
+
+		if args.trace and any(entobj.metrics for entobj in ents):
+			metrics = Metrics()
+			for entobj in ents:
+				if entobj.metrics:
+					metrics.records.extend(entobj.metrics.records)
+			try:
+				with open(args.trace, "w") as f:
+					metrics.trace(f)
+			except IOError as e:
+				log.error("Error writing trace to %s: %s", args.trace, e)
+
+		for entobj, name in zip(ents, statenames):
+			try:
+				entobj.saveState()
+			except (IOError, sqlite3.Error) as e:
+				log.error("Error saving state to %s: %s", name, e)
 
 		try:
-			with open(statename, "w") as of:
-				sums = {f.path: f.md5sum for f in entobj.files.values() if f.md5sum}
-				json.dump(sums, of, indent=1)
+			fpcache.save()
 		except IOError as e:
-			print("I/O error({0}): {1}".format(e.errno, e.strerror))
+			log.error("I/O error({0}): {1}".format(e.errno, e.strerror))
+		return status
 
 class InputError(Exception):
 	"""Exception raised for errors in the input.
@@ -100,24 +328,201 @@ class InputError(Exception):
 ##############################################
 
 def md5sum(fname):
+	""" Legacy fingerprint (md5 of the modification time) of fname """
+	return fingerprint(fname, 'mtime')
+
+def normpath(path):
+	""" Normalized path, the same as str(pathlib.Path(path)) but without
+	creating a Path: repeated /'s and . components are removed, .. is kept
+	and a leading // (but not ///) is kept as POSIX allows """
+	if not path:
+		return '.'
+	if path[0] == '/':
+		root = '//' if path[:2] == '//' and path[2:3] != '/' else '/'
+	else:
+		root = ''
+	if '//' not in path and '/.' not in path and not path.endswith('/') \
+			and not path.startswith('./') and path != '.':
+		return path
+	parts = [p for p in path.split('/') if p and p != '.']
+	return (root + '/'.join(parts)) or '.'
+
+def split_path(path):
+	""" (directory, name) of a normalized path, the same as os.path.split():
+	the directory of a relative path with a single component is '' and a
+	root ('/' or '//') is its own directory, with an empty name """
+	ii = path.rfind('/') + 1
+	head = path[:ii]
+	return head.rstrip('/') or head, path[ii:]
+
+def fingerprint(fname, mode = 'mtime', cache = None):
+	""" Computes fingerprints for a path or list of paths, returns
+	{path: fingerprint} for every path that exists.
+
+	Parameters
+	----------
+	fname : string or list of strings
+		paths to fingerprint
+	mode : string
+		one of FINGERPRINTS:
+		mtime - md5 of the modification time (the original format)
+		stat  - modification time and size
+		md5   - md5 of the file contents
+		fast  - crc32 of the file contents (non-cryptographic)
+	cache : FingerprintCache
+		if given, content hashes are only recomputed for paths whose
+		(inode, size, mtime) changed since they were last hashed
+	"""
 	out = dict()
 	if type(fname) != type([]):
 		fname = [fname]
 
 	for ff in fname:
+		p = normpath(ff)
 		try:
-			p = Path(ff)
-			m = hashlib.md5()
-			stat = p.stat()
-			m.update(str(stat.st_mtime).encode())
-			out[str(p)] = m.hexdigest()
-		except FileNotFoundError:
-			pass
+			stat = os.stat(p)
 		except OSError as e:
-			pass
+			continue
+
+		fp = fingerprint_stat(p, stat, mode, cache)
+		if fp:
+			out[p] = fp
 
 	return out
 
+def fingerprint_stat(path, stat, mode, cache = None):
+	""" Fingerprint of path given its os.stat() result, None if the file
+	could not be read """
+	if mode == 'mtime':
+		return hashlib.md5(str(stat.st_mtime).encode()).hexdigest()
+	elif mode == 'stat':
+		return 'stat:%x:%x' % (stat.st_size, stat.st_mtime_ns)
+	elif mode not in FINGERPRINTS:
+		raise InputError(mode, "Unknown fingerprint mode")
+
+	# The content of a directory is produced by other jobs, all that
+	# matters is that the directory exists
+	if S_ISDIR(stat.st_mode):
+		return '%s:dir' % mode
+
+	if cache is not None:
+		fp = cache.lookup(path, stat, mode)
+		if fp:
+			return fp
+
+	try:
+		with open(path, 'rb') as f:
+			if mode == 'md5':
+				m = hashlib.md5()
+				for block in iter(lambda: f.read(HASHBLOCK), b''):
+					m.update(block)
+				fp = 'md5:' + m.hexdigest()
+			else:
+				crc = 0
+				for block in iter(lambda: f.read(HASHBLOCK), b''):
+					crc = zlib.crc32(block, crc)
+				fp = 'fast:%x:%08x' % (stat.st_size, crc)
+	except OSError as e:
+		return None
+
+	if cache is not None:
+		cache.store(path, stat, mode, fp)
+	return fp
+
+def scan_files(fname, mode = 'mtime', cache = None, nthreads = None,
+		progress = None):
+	""" Parallel version of fingerprint() for large lists of paths. Paths are
+	grouped by directory, directories with many requested entries are read
+	with a single os.scandir() rather than one stat() per path, and the
+	directories are spread over a pool of threads.
+
+	Parameters
+	----------
+	fname : list of strings
+		normalized paths (as in File.path) to fingerprint, or the paths
+		already grouped, {directory: {name: path}} (see FileIndex.bydir)
+	mode, cache :
+		see fingerprint(), paths in cache.known are taken from there rather
+		than looked at again
+	nthreads : int
+		number of directories to scan concurrently
+	progress : function(ndone, ntotal)
+		called after each directory is finished
+
+	Returns
+	-------
+	({path: fingerprint}, stats) where stats is a dict with the number of
+	files, directories and fingerprints found and the elapsed seconds
+	"""
+	start = time.time()
+	if type(fname) == dict:
+		bydir = fname
+	else:
+		bydir = dict()
+		for ff in fname:
+			dname, name = os.path.split(ff)
+			bydir.setdefault(dname, dict())[name] = ff
+	nfiles = sum(len(names) for names in bydir.values())
+
+	sums = dict()
+	known = cache.known if cache is not None else None
+	if known:
+		rest = dict()
+		for dname, names in bydir.items():
+			left = dict()
+			for name, ff in names.items():
+				if ff in known:
+					sums[ff] = known[ff]
+				else:
+					left[name] = ff
+			if left:
+				rest[dname] = left
+		bydir = rest
+
+	def scandir(item):
+		dname, names = item
+		out = dict()
+		if len(names) < SCANDIR_MIN or '' in names or '.' in names \
+				or '..' in names:
+			for ff in names.values():
+				try:
+					stat = os.stat(ff)
+				except OSError as e:
+					continue
+				fp = fingerprint_stat(ff, stat, mode, cache)
+				if fp:
+					out[ff] = fp
+			return out
+
+		try:
+			with os.scandir(dname or '.') as it:
+				for entry in it:
+					ff = names.get(entry.name)
+					if ff is None:
+						continue
+					try:
+						stat = entry.stat()
+					except OSError as e:
+						continue
+					fp = fingerprint_stat(ff, stat, mode, cache)
+					if fp:
+						out[ff] = fp
+		except OSError as e:
+			pass
+		return out
+
+	with concurrent.futures.ThreadPoolExecutor(nthreads or SCANTHREADS) as pool:
+		for ii, out in enumerate(pool.map(scandir, bydir.items())):
+			sums.update(out)
+			if known is not None:
+				known.update(out)
+			if progress:
+				progress(ii+1, len(bydir))
+
+	stats = {'files' : nfiles, 'directories' : len(bydir),
+			'found' : len(sums), 'seconds' : time.time() - start}
+	return sums, stats
+
 def parseV2(filename):
 	"""Reads a file and returns Generators, and variables as a tuple
 
@@ -129,6 +534,8 @@ def parseV2(filename):
 				"inputs" : ["{SUBJECT}/image"],
 				"outputs" : ["{SUBJECT}/outimage"]
 				"commands" : ["cp $< $>", "touch $<"]
+				"runtime" : 60,  (optional, estimated seconds per job)
+				"limit" : 10     (optional, jobs allowed to run at once)
 			},
 			...etc
 		]
@@ -141,43 +548,135 @@ def parseV2(filename):
 	"""
 
 	varre = re.compile('\s*([a-zA-Z0-9_.]+)(?:\[\s*([a-zA-Z0-9_.]+)\s*\])?\s*')
-	variables = dict()
 	jobs = []
+	outvariables = {'.PWD' : [os.getcwd()]}
+	seen = set()
+
+	# Stream the file one variable/generator at a time rather than loading
+	# the whole document, which for large trees is several times the size
+	# of the file
 	with open(filename, "r") as f:
-		infile = json.load(f)
-		variables = infile['variables']
-
-		# Check Variable
-		outvariables = {}
-		for kk,vv in variables.items():
-			if type(vv) != type([]):
-				vv = [vv]
-
-			m = varre.match(kk)
-			if m.group(2):
-				# there is a dependent variable, indicate in value
-				vv = (vv, m.group(2))
-				kk = m.group(1)
-
-			# Add variable
-			outvariables[kk] = vv
-
-		for g in infile['generators']:
-			inputs = g['inputs']
-			outputs = g['outputs']
-			commands = g['commands']
-			if type(inputs) != type([]):
-				inputs = [inputs]
-			if type(outputs) != type([]):
-				outputs = [outputs]
-			if type(commands) != type([]):
-				commands = [commands]
-
-			jobs.append(Generator(inputs, outputs))
-			jobs[-1].cmds = commands
+		stream = JsonStream(f)
+		for section in stream.members():
+			if section == 'variables':
+				for kk in stream.members():
+					vv = stream.value()
+					if type(vv) != type([]):
+						vv = [vv]
+
+					m = varre.match(kk)
+					if m.group(2):
+						# there is a dependent variable, indicate in value
+						vv = (vv, m.group(2))
+						kk = m.group(1)
+
+					# Add variable
+					outvariables[kk] = vv
+			elif section == 'generators':
+				for ii in stream.items():
+					g = stream.value()
+					inputs = g['inputs']
+					outputs = g['outputs']
+					commands = g['commands']
+					if type(inputs) != type([]):
+						inputs = [inputs]
+					if type(outputs) != type([]):
+						outputs = [outputs]
+					if type(commands) != type([]):
+						commands = [commands]
+
+					# bool is an int, but not a number of seconds or jobs
+					runtime = g.get('runtime')
+					limit = g.get('limit')
+					if runtime is not None and (type(runtime) not in
+							(int, float) or not 0 <= runtime < float('inf')):
+						raise InputError(filename, "Error! runtime of %s "
+								"must be a number of seconds >= 0, not %r" %
+								(outputs, runtime))
+					if limit is not None and (type(limit) != int or
+							limit < 1):
+						raise InputError(filename, "Error! limit of %s must "
+								"be a number of jobs >= 1, not %r" %
+								(outputs, limit))
+
+					jobs.append(Generator(inputs, outputs))
+					jobs[-1].cmds = commands
+					jobs[-1].runtime = runtime
+					jobs[-1].limit = limit
+			else:
+				stream.value()
+			seen.add(section)
+
+	for section in ('variables', 'generators'):
+		if section not in seen:
+			raise InputError(filename, "Error! No %s in %s" % (section,
+				filename))
 
+	link_variables(outvariables)
 	return (jobs, outvariables)
 
+def link_variables(variables):
+	""" Prepares dependent variables (EXTRA[SUBJ] = a b c), which the
+	parsers store as (values, parent), for lookup. Each is replaced by
+	(values, parent, {parentvalue: index}) so that the value for a
+	realization of the parent is found without searching. Raises InputError
+	if the parent is unknown or the lengths differ.
+	"""
+	for name, value in variables.items():
+		if type(value) != type(()):
+			continue
+		values, parent = value[0], value[1]
+		if parent not in variables:
+			raise InputError(name, "Error! %s depends on unknown variable %s"
+					% (name, parent))
+		parentvals = variables[parent]
+		if type(parentvals) == type(()):
+			raise InputError(name, "Error! %s depends on %s, which is itself "
+					"dependent" % (name, parent))
+		if len(parentvals) != len(values):
+			raise InputError(name, "Error! %s has %i values but %s, which it "
+					"depends on, has %i" % (name, len(values), parent,
+					len(parentvals)))
+
+		lookup = dict()
+		for ii, pv in enumerate(parentvals):
+			lookup.setdefault(pv, ii)
+		variables[name] = (values, parent, lookup)
+
+def logical_lines(f):
+	""" Generates the lines of f with lines that end in \\ joined to the
+	next, trailing white space and comments (from the first #) removed """
+	parts = []
+	for line in itertools.chain(f, [None]):
+		if line is None:
+			# end of file, after a \\
+			if not parts:
+				return
+			line = ""
+		elif line[-2:] == "\\\n":
+			parts.append(line[:-2])
+			continue
+		elif line[-3:] == "\\\r\n":
+			parts.append(line[:-3])
+			continue
+
+		if parts:
+			parts.append(line)
+			line = "".join(parts)
+			parts = []
+		line = line.rstrip()
+		cut = line.find('#')
+		if cut >= 0:
+			line = line[:cut]
+		yield line
+
+def split_values(string):
+	""" shlex.split(string), without shlex when there is nothing to
+	unquote """
+	if '"' in string or "'" in string or '\\' in string:
+		return shlex.split(string)
+	return valuere.findall(string)
+
 def parseV1(filename):
 	"""Reads a file and returns Generators, and variables as a tuple
 
@@ -185,242 +684,232 @@ def parseV1(filename):
 	Variable values may be anything but white space, multiple values may
 	be separated by white space
 
+	The file is read one line at a time, in a single pass.
 	"""
 	iomre = re.compile("\s*([^:]*?)\s*:(?!//)\s*(.*?)\s*")
 	varre = re.compile("\s*([a-zA-Z0-9_.]+)(?:\[\s*([a-zA-Z0-9_.]+)\s*\])?\s*=\s*(.*?)\s*")
 	cmdre = re.compile("\t\s*(.*?)\s*")
-	commentre = re.compile("(.*?)#.*")
 
-	with open(filename, "r") as f:
-		lines = f.readlines()
-
-	lineno=0
-	fullline = ""
 	cgen = None
 
 	# Outputs
 	jobs = []
-	variables = {'.PWD' : os.getcwd()}
-
-	## Clean Input
-	# Merge Lines that end in \ and remove trailing white space:
-	buff = []
-	tmp = ""
-	for line in lines:
-		if line[-2:] == "\\\n":
-			tmp += line[:-2]
-		elif line[-3:] == "\\\r\n":
-			tmp += line[:-3]
-		else:
-			buff.append(tmp+line.rstrip())
-			tmp = ""
-	lines = buff
-
-	# Remove comments
-	for ii in range(len(lines)):
-
-		# remove comments
-		match = commentre.search(lines[ii])
-		if match:
-			lines[ii] = match.group(1)
-
-	for line in lines:
-		if VERBOSE > 4: print("line %i:\n%s" % (lineno, line))
-
-		# if there is a current Generator we are building
-		# then first try to append commands to it
-		if cgen:
-			cmdmatch = cmdre.fullmatch(line)
-			if cmdmatch:
-				# append the extra command to the Generator
-				cgen.cmds.append(cmdmatch.group(1))
+	variables = {'.PWD' : [os.getcwd()]}
+
+	with open(filename, "r") as f:
+		for lineno, line in enumerate(logical_lines(f), 1):
+			log.log(TRACE, "line %i:\n%s", lineno, line)
+
+			# if there is a current Generator we are building
+			# then first try to append commands to it
+			if cgen:
+				cmdmatch = cmdre.fullmatch(line)
+				if cmdmatch:
+					# append the extra command to the Generator
+					cgen.cmds.append(cmdmatch.group(1))
+					continue
+				else:
+					# done with current Generator, remove current link
+					jobs.append(cgen)
+					log.debug("Adding Generator: %s", cgen)
+					cgen = None
+
+			# if this isn't a command, try the other possibilities, a rule
+			# has a : (which a variable may also have)
+			iomatch = ':' in line and iomre.fullmatch(line)
+			if iomatch:
+				# expand inputs/outputs
+				inputs = iomatch.group(2).split()
+				outputs = iomatch.group(1).split()
+
+				# create a new generator
+				cgen = Generator(inputs, outputs)
+				log.debug("New Generator: %s:%s", inputs, outputs)
 				continue
-			else:
-				# done with current Generator, remove current link
-				jobs.append(cgen)
-				if VERBOSE > 0: print("Adding Generator: %s" % cgen)
-				cgen = None
-
-		# if this isn't a command, try the other possibilities
-		iomatch = iomre.fullmatch(line)
-		varmatch = varre.fullmatch(line)
-		if iomatch:
-			# expand inputs/outputs
-			inputs = re.split("\s+", iomatch.group(2))
-			outputs = re.split("\s+", iomatch.group(1))
-			inputs = [s for s in inputs if len(s) > 0]
-			outputs = [s for s in outputs if len(s) > 0]
-
-			# create a new generator
-			cgen = Generator(inputs, outputs)
-			if VERBOSE > 3: print("New Generator: %s:%s" % (inputs, outputs))
-		elif varmatch:
-			# split variables
-			name = varmatch.group(1)
-			values = shlex.split(varmatch.group(3))
-			if name in variables:
-				print("Error! Redefined variable: %s" % name)
-				return (None, None)
-			if VERBOSE > 3: print("Defining: %s = %s"%(name, str(values)))
-
-			if varmatch.group(2):
-				# dependent variables are tuples with the values, with the dep
-				variables[name] = (values, varmatch.group(2))
-			else:
-				variables[name] = values
-		else:
-			continue
 
-	if VERBOSE > 3: print("Done With Initial Pass!")
+			varmatch = '=' in line and varre.fullmatch(line)
+			if varmatch:
+				# split variables
+				name = varmatch.group(1)
+				values = split_values(varmatch.group(3))
+				if name in variables:
+					log.error("Error! Redefined variable: %s (line %i)", name,
+							lineno)
+					return (None, None)
+				log.debug("Defining: %s = %s", name, values)
+
+				if varmatch.group(2):
+					# dependent variables are tuples with the values, with
+					# the dep
+					variables[name] = (values, varmatch.group(2))
+				else:
+					variables[name] = values
+
+	# the last Generator, if nothing follows its commands
+	if cgen:
+		jobs.append(cgen)
+		log.debug("Adding Generator: %s", cgen)
 
+	log.debug("Done With Initial Pass!")
+
+	link_variables(variables)
 	return (jobs, variables)
 
-def expand_variables(inlist, localvars, gvars):
-	# This is more complicated than it might seem because
-	# [${SUBJECT} ${SUBJECT}] might exist in the output so a the same
-	# variable should not be expanded twice. To handle this, we need to
-	# create lists of dictionaries of local variables that represent one
-	# expansion
-	varre = re.compile('\${\s*([a-zA-Z0-9_.]+)\s*}')
+@functools.lru_cache(maxsize=1<<16)
+def tokenize(string):
+	""" Splits string on ${VAR} references, returns (literals, names) where
+	literals has one more element than names and the string is
+	literals[0] + ${names[0]} + literals[1] + ... """
+	literals = []
+	names = []
+	prevend = 0
+	for match in tokenre.finditer(string):
+		literals.append(string[prevend:match.start()])
+		names.append(match.group(1))
+		prevend = match.end()
+	literals.append(string[prevend:])
+	return tuple(literals), tuple(names)
 
+def expand_variables(inlist, localvars, gvars):
+	""" Generates every realization of the variables referenced by the
+	strings in inlist, yields (paths, bindings) where paths is inlist with
+	all the variables substituted and bindings is a dict {varname: value}
+	of the values used (including those given in localvars).
+
+	This is more complicated than it might seem because
+	[${SUBJECT} ${SUBJECT}] might exist in the output so a the same
+	variable should not be expanded twice. Variables are bound once per
+	realization and all strings are substituted together. Values that refer
+	to other variables are expanded again, breadth first, so the order of
+	realizations matches earlier versions.
+
+	Parameters
+	----------
+	inlist : list of strings
+		strings (paths) to expand, nothing is generated for an empty list
+	localvars : dict {varname: value}
+		variables that are already bound
+	gvars : dict {varname: [value...] }
+		global variables used to look up values
+	"""
 	if not inlist:
-		return [], []
-
-	# 1) find all variables in outputs
-	# 2) expand each variable into the list of values it takes on
-	# 3) create list of every combination of every list variable as a
-	# dictionary of local variables
-	# 4) repeat on 1) on the expanded outputs
-	ii = 0
-	valreal = [copy.deepcopy(localvars)]
-	outputs = [copy.deepcopy(inlist)]
-	while ii < len(outputs):
-		# Find All Variables, Across Output Files
-		curout = copy.deepcopy(outputs[ii])
-		localvars = copy.deepcopy(valreal[ii])
-		expvars = []
-		depvars = []
-		change = False
-		# Convert [file, file, file] to [[partial, var, partial], ...]
-		for jj in range(len(curout)):
-			print(curout[jj])
-			parscur = []
-			prevend = 0
-			for match in varre.finditer(curout[jj]):
-				parscur.append(curout[jj][prevend:match.start()])
-				parscur.append(match.group(0))
-				prevend = match.end()
-				change = True
-				iv = match.group(1)
-				if iv in localvars:
-					pass
-				elif iv in gvars and type(gvars[iv]) == type(()):
-					# if this variable depends on another
-					expvars.append(gvars[iv][1]) # expand parent
-					depvars.append(iv) # save this as a dependent variable
-				elif iv in gvars:
-					expvars.append(iv)
-				else:
-					raise InputError("genJobs", "Error! Unknown global "
-							" variable reference: %s" % iv)
-			parscur.append(curout[jj][prevend:])
-			if parscur:
-				curout[jj] = [p for p in parscur if p]
+		return
+
+	# Each element of pending is an iterator over (paths, bindings) of one
+	# expansion step. Pulling from the front and pushing the children of
+	# unfinished paths to the back is a lazy breadth first traversal.
+	pending = collections.deque([iter([(list(inlist), dict(localvars))])])
+	while pending:
+		for paths, bindings in pending[0]:
+			children = expand_once(paths, bindings, gvars)
+			if children is None:
+				yield paths, bindings
+			else:
+				pending.append(children)
+		pending.popleft()
+
+def expand_once(paths, localvars, gvars):
+	""" Substitutes one level of variable references in paths. Returns None
+	if there are no references, otherwise a generator of (paths, bindings)
+	with one element for every combination of the values of the unbound
+	variables referenced """
+	tokens = [tokenize(p) for p in paths]
+
+	# 1) find all variables in paths that are not already bound, dependent
+	# variables expand their parent instead
+	expvars = []
+	depvars = []
+	change = False
+	for literals, names in tokens:
+		for iv in names:
+			change = True
+			if iv in localvars:
+				pass
+			elif iv in gvars and type(gvars[iv]) == type(()):
+				# if this variable depends on another
+				depvars.append(iv) # save this as a dependent variable
+				parent = gvars[iv][1]
+				if parent not in localvars:
+					expvars.append(parent) # expand parent
+			elif iv in gvars:
+				expvars.append(iv)
 			else:
-				curout[jj] = [curout[jj]]
-
-		# make expansion vars unique and check for higher depth dependencies
-		# which are note allowed
-		expvars = list(set(expvars))
-		for var in expvars:
-			if type(gvars[var]) == type(()):
-				print("Error variable %s is a dependent on variable but "\
-						"depends on %s" % (var, gvars[var][1]))
-
-		# expand variable into list which includes the values from
-		# localvars
-		newlocalvars = []
-		for varset in itertools.product(*[gvars[e] for e in expvars]):
-			newlvar = copy.deepcopy(localvars)
-			for i in range(len(varset)):
-				newlvar[expvars[i]] = varset[i]
-			newlocalvars.append(newlvar)
+				raise InputError("genJobs", "Error! Unknown global "
+						" variable reference: %s" % iv)
+	if not change:
+		return None
+
+	# make expansion vars unique (in order of appearance) and check for
+	# higher depth dependencies which are not allowed
+	expvars = list(dict.fromkeys(expvars))
+	depvars = list(dict.fromkeys(depvars))
+	for var in expvars:
+		if var not in gvars:
+			raise InputError("genJobs", "Error! Unknown global "
+					" variable reference: %s" % var)
+		if type(gvars[var]) == type(()):
+			raise InputError("genJobs", "Error variable %s is a dependent "
+					"on variable but depends on %s" % (var, gvars[var][1]))
+
+	return _expand_product(tokens, localvars, gvars, expvars, depvars)
+
+def _expand_product(tokens, localvars, gvars, expvars, depvars):
+	# 2) every combination of the values of the expanded variables is a new
+	# set of bindings, 3) dependent variables take the value at the same
+	# index as their parent's value, 4) substitute
+	for varset in itertools.product(*[gvars[e] for e in expvars]):
+		bindings = dict(localvars)
+		bindings.update(zip(expvars, varset))
 
 		# Add variable definitions for all the dependent variables based
 		# on its dependencies, so for EXTRA[SUBJ] = a b c, lookup SUBJ
 		# convert 10588 10659 10844 to indexes
 		for depvar in depvars:
 			depval = gvars[depvar]
-			parentvar = depval[1]
-			parentval = gvars[depval[1]]
-			for varset in newlocalvars:
-				varset[depvar] = depval[0][parentval.index(varset[parentvar])]
-
-		# current set of outputs now has a new set of local vars for every
-		# combination of variables. Currout has already been split based on
-		# variable so just take replace the variables
-		newout = [[copy.deepcopy(j) for j in curout] for i in newlocalvars]
-		for kk in range(len(newout)):
-			for jj in range(len(newout[kk])):
-				for ll in range(len(newout[kk][jj])):
-					m = varre.match(newout[kk][jj][ll])
-					# expand variables
-					if m and m.group(1):
-						newout[kk][jj][ll] = newlocalvars[kk][m.group(1)]
-				# Re-merge the list to a string
-				newout[kk][jj] = "".join(newout[kk][jj])
-		if change:
-			outputs.extend(newout)
-			valreal.extend(newlocalvars)
-			del(outputs[ii])
-			del(valreal[ii])
-		else:
-			ii += 1
-	return outputs, valreal
-
-## Expand String Based on Local (First) then Global Variables
-# only expands variables that match ${[a-zA-Z0-9_]}
-def resolve_variables(inlist, localvars, gvars):
-	# the expanded version (for instance if there are multi-value)
-	# arguments
-	ii = 0
-	print("Expanding", inlist, localvars)
-	outlist = copy.deepcopy(inlist)
-	while ii < len(outlist):
-		tmp = outlist[ii]
-		match = gvarre.fullmatch(tmp)
-		if match:
-			pref = match.group(1)
-			name = match.group(2)
-			suff = match.group(3)
-
-			# resolve variable name
-			if name in localvars:
-				# variable in the list of output vars, just sub in
-				outlist[ii] = pref + localvars[name] + suff
-			elif name in gvars:
-				# if it is a global variable, then we don't have a
-				# value from output, if there are multiple values
-				# then it is a compound (multivalue) input
-				realvals = gvars[name]
-				if len(realvals) == 1:
-					tmp = pref + realvals[0] + suff
-					outlist[ii] = tmp
-				else:
-					raise InputError("resolve_variables", "Error cannot place "
-							"variables length variable in a command")
+			bindings[depvar] = depval[0][depval[2][bindings[depval[1]]]]
+
+		paths = []
+		for literals, names in tokens:
+			parts = [literals[0]]
+			for name, literal in zip(names, literals[1:]):
+				parts.append(bindings[name])
+				parts.append(literal)
+			paths.append("".join(parts))
+		yield paths, bindings
+
+@functools.lru_cache(maxsize=1<<16)
+def compile_template(string):
+	""" Splits a command string into a tuple of (kind, value) pieces, see
+	CommandTemplate. Adjacent literal text is kept as one piece. """
+	pieces = []
+	prevend = 0
+	for m in templatere.finditer(string):
+		if m.start() > prevend:
+			pieces.append((CommandTemplate.LITERAL, string[prevend:m.start()]))
+		prevend = m.end()
+
+		if m.group(1):
+			pieces.append((CommandTemplate.VARIABLE, m.group(1)))
+			continue
+
+		io = m.group(2) or m.group(3)
+		if m.group(4):
+			if io == '<':
+				pieces.append((CommandTemplate.INPUT, int(m.group(4))))
 			else:
-				raise InputError('expand_string', 'Error, input ' + \
-						'"%s" references variable "%s"' % (instr, name) + \
-						'which is a unknown!')
+				pieces.append((CommandTemplate.OUTPUT, int(m.group(4))))
+		elif io == '<':
+			pieces.append((CommandTemplate.ALLIN, None))
 		else:
-			ii += 1
+			pieces.append((CommandTemplate.ALLOUT, None))
 
-	return outlist
+	if prevend < len(string):
+		pieces.append((CommandTemplate.LITERAL, string[prevend:]))
+	return tuple(pieces)
 
 ##
 # @brief Parses a string with ${<} type syntax with the contents of
-# defs. If a variable contains more variable those are resolved as well.
+# defs. Variables (${VAR}) are left as they are.
 # Special definitions:
 # ${<} replaced with all inputs
 # ${<N} where N is >= 0, replaced the the N'th input
@@ -432,54 +921,8 @@ def resolve_variables(inlist, localvars, gvars):
 #
 # @return
 def expand_args(string, inputs, outputs):
-	# $> - 0 - all outputs
-	# $< - 1 - all inputs
-	# ${>#} - 2 - output number outputs
-	# ${<#} - 3 - output number outputs
-
-	allout  = "(\$>|\${>})|"
-	allin   = "(\$<|\${<})|"
-	singout = "\${>\s*([0-9]*)}|"
-	singin  = "\${<\s*([0-9]*)}"
-	r = re.compile(allout+allin+singout+singin)
-
-	## Convert Inputs Outputs to Strings
-	inputs = [f.path for f in inputs]
-	outputs = [f.path for f in outputs]
-
-	ostring = string
-	m = r.search(ostring)
-	ii = 0
-	while m:
-		ii += 1
-		# perform lookup
-		if m.group(1):
-			# all out
-			insert = " ".join(outputs)
-		elif m.group(2):
-			# all in
-			insert = " ".join(inputs)
-		elif m.group(3):
-			# singout
-			i = int(m.group(3))
-			if i < 0 or i >= len(outputs):
-				raise InputError("expand", "Error Resolving Output number "
-						"%i in\n%s" % (i, string))
-			insert = outputs[i]
-		elif m.group(4):
-			# singin
-			i = int(m.group(4))
-			if i < 0 or i >= len(inputs):
-				raise InputError("expand", "Error Resolving input number "
-						"%i in\n%s" % (i, string))
-			insert = inputs[i]
-
-		ostring = ostring[:m.start()] + insert + ostring[m.end():]
-		m = r.search(ostring)
-		if ii == 100:
-			raise InputError("Circular Variable References Detected!")
-
-	return ostring
+	return CommandTemplate(string).render([f.path for f in inputs],
+			[f.path for f in outputs])
 
 ###############################################################################
 # Classes
@@ -497,192 +940,886 @@ class Ent:
 
 	"""
 
-	def __init__(self, entfile = None, statefile = None):
-		""" Ent Constructor """
+	def __init__(self, entfile = None, statefile = None, fpmode = 'mtime',
+			fpcache = None, nthreads = None, lazy = False, treecache = None,
+			readonly = False):
+		""" Ent Constructor
+
+		Parameters
+		----------
+		entfile : string
+			.ent or .json script to load
+		statefile : string
+			file that fingerprints of finished outputs are stored in
+		fpmode : string
+			how files are fingerprinted, one of FINGERPRINTS
+		fpcache : FingerprintCache
+			cache of content hashes, used by the md5 and fast modes
+		nthreads : int
+			number of threads used to fingerprint files
+		lazy : bool
+			expand jobs while running rather than all at once (see load)
+		treecache : string
+			directory to keep expanded trees in, so that an unchanged script
+			isn't parsed and expanded again (see save_tree), only read if
+			readonly
+		readonly : bool
+			only read the state file, don't create or convert it (to
+			simulate)
+		"""
 		self.error = 0
-		self.files = dict()
-		self.variables = {'.PWD' : os.getcwd()}
+		self.files = FileIndex()
+		self.variables = {'.PWD' : [os.getcwd()]}
 		self.jobs = list()
 		self.md5state = statefile
+		self.state = None # StateStore of md5state, opened by load()
+		self.fpmode = fpmode
+		self.fpcache = fpcache
+		self.nthreads = nthreads
+		self.scanstats = dict()
+		self.geners = list()
+		self.sums = dict()
+		self.signatures = dict() # {StateStore.jobkey: Job.signature}
+		self.adopted = dict() # signatures to add to the state (see upToDate)
+		self.runtimes = dict() # {StateStore.jobkey: seconds}
+		self.pending = None # batches of jobs that have yet to be expanded
+		self.expanding = 0 # index of the first Generator with jobs left
+		self.events = EventLog()
+		self.workdir = WORKDIR # files shared with jobs
+		self.treecache = treecache
+		self.readonly = readonly
+
+		# State of a run, see startRun()
+		self.executor = None
+		self.sched = None
+		self.running = dict()
+		self.startqueue = list()
+		self.metrics = None # Metrics of the last run
+		self.paused = False # don't start new jobs (commands of running jobs
+		                    # still are)
 
 		# load the file
 		if entfile:
-			self.load(entfile)
+			self.load(entfile, lazy)
+
+	def load(self, entfile, lazy = False):
+		""" Parse entfile and expand it into jobs. If lazy is set, jobs are
+		only expanded as run() asks for them (see materialize()). Otherwise
+		the expanded tree is reused from self.treecache if the script hasn't
+		changed. """
+		key = None
+		if self.treecache and not lazy:
+			key = tree_key(entfile)
+			cachefile = tree_file(self.treecache, entfile)
+			tree = load_tree(cachefile, key)
+			if tree:
+				self.geners, self.variables, self.jobs, self.files = tree
+				log.info("Loaded %i jobs using %i files from %s",
+						len(self.jobs), len(self.files), cachefile)
+				self.sums = self.readState()
+				self.check()
+				return
 
-	def load(self, entfile):
-		print(entfile)
 		if entfile[-5:] == '.json':
-			print("Parsing json")
-			geners, self.variables = parseV2(entfile)
+			log.info("Parsing json %s", entfile)
+			self.geners, self.variables = parseV2(entfile)
 		elif entfile[-4:] == '.ent':
-			print("Parsing ent")
-			geners, self.variables = parseV1(entfile)
+			log.info("Parsing ent %s", entfile)
+			self.geners, self.variables = parseV1(entfile)
 		else:
 			raise 'unknown file type'
 
+		# Read MD5 State From File
+		self.sums = self.readState()
+
+		if lazy:
+			self.pending = self.materialize()
+			return
+
 		# expand all the Generators into Jobs
-		for bb in geners:
+		for bb in self.geners:
 			# get jobs and files this generates
 			jlist = bb.genJobs(self.files, self.variables)
 			if jlist == None:
 				return -1
-			# Resolve Variable Names in Commands
-			for job in jlist:
-				print("Expanding input/output arguments for \n%s" % str(job))
-				print(job.inputs)
-				print(job.outputs)
-				print(job.cmds)
-				for ii in range(len(job.cmds)):
-					job.cmds[ii] = expand_args(job.cmds[ii], job.inputs, \
-							job.outputs)
-
 			# add jobs to list of jobs
 			self.jobs.extend(jlist)
 
-		if VERBOSE > 6:
-			print("All Jobs: ")
-			for j in self.jobs:
-				print(j)
+		log.info("Expanded %i jobs using %i files", len(self.jobs),
+				len(self.files))
+		if log.isEnabledFor(TRACE):
+			log.log(TRACE, "All Jobs: %s", "".join(str(j) for j in self.jobs))
+
+		if key and not self.readonly:
+			try:
+				save_tree(cachefile, key, self.geners, self.variables,
+						self.jobs, self.files)
+			except (OSError, ValueError) as e:
+				log.warning("Could not save tree to %s: %s", cachefile, e)
 
+		self.check()
+
+	def check(self):
+		""" Fingerprint every file and set the status of every job """
 		##################################################################
-		# Read MD5 State From File, and compare with current MD5s
+		# Compare State with current MD5s
 		##################################################################
 
 		# Update File database with current md5sums
-		flist = [f.path for f in self.files.values()]
-		newsums = md5sum(flist)
-		print("MD5 Sums in Filesystem: %s" % json.dumps(newsums, indent=1))
+		newsums = self.scan(self.files.bydir())
+		if log.isEnabledFor(TRACE):
+			log.log(TRACE, "MD5 Sums in Filesystem: %s",
+					json.dumps(newsums, indent=1))
 		for f in self.files.values():
 			if f.path in newsums:
 				f.md5sum = newsums[f.path]
 
-		# Read State File
-		try:
-			with open(self.md5state, "r") as f:
-				sums = json.load(f)
-			print("MD5 Sums from State File: %s" % json.dumps(sums, indent=1))
-		except:
-			if self.md5state:
-				print("Warning %s does not exist" % self.md5state)
+		self.updateStatus(self.jobs)
+
+	def readState(self):
+		""" Opens the state file, returns the {path: fingerprint} stored in
+		it """
+		if not self.md5state:
+			log.warning("No state file given, no state will be read or saved")
+			return dict()
+
+		if not os.path.exists(self.md5state):
+			log.warning("%s does not exist", self.md5state)
+		if self.state is None:
+			self.state = openState(self.md5state, self.readonly)
+		sums = self.state.load()
+		self.signatures = self.state.signatures()
+		self.runtimes = self.state.runtimes()
+		if log.isEnabledFor(TRACE):
+			log.log(TRACE, "MD5 Sums from State File: %s",
+					json.dumps(sums, indent=1))
+		return sums
+
+	def saveState(self):
+		""" Stores the current fingerprint of every file that is up to date
+		(not the output of a job that failed or didn't run) in the state
+		file and closes it """
+		if self.state is None:
+			return
+		self.adoptSignatures()
+		self.state.save({f.path: f.md5sum for f in self.files.values()
+				if f.md5sum and (f.genr is None or
+					f.genr.status == 'SUCCESS')})
+		self.state.close()
+		self.state = None
+
+	def upToDate(self, job):
+		""" Whether the outputs of job all match the state file and, if the
+		state file keeps signatures, the signature stored for job matches
+		its commands and inputs. A job without one isn't up to date, unless
+		the state file was converted from JSON in this run, which has none:
+		the signature it has now is kept then (see adopted). """
+		sums = self.sums
+		for out in job.outputs:
+			p = out.path
+			if p not in sums or not out.md5sum or sums[p] != out.md5sum:
+				return False
+
+		if self.state is not None and self.state.signed:
+			key = StateStore.jobkey(job)
+			sig = self.signatures.get(key)
+			if sig is None and self.state.converted:
+				sig = self.signatures[key] = self.adopted[key] = \
+						job.signature()
+			if sig is None:
+				log.debug("No signature for Job: %s", job.cmds)
+				return False
+			if sig != job.signature():
+				log.debug("Commands or inputs changed for Job: %s", job.cmds)
+				return False
+		return True
+
+	def updateStatus(self, jobs):
+		""" Jobs that are up to date are SUCCESS, the rest are WAITING. So
+		are the jobs downstream of them (in jobs): their inputs are going to
+		be remade, they are checked again when they are ready to run (see
+		step) """
+		stack = []
+		for job in jobs:
+			log.log(TRACE, "%s", job)
+			if self.upToDate(job):
+				job.status = 'SUCCESS'
+				log.debug("All Outputs Exist for Job: %s", job.cmds)
 			else:
-				print("Warning no state file given, no state will be read "
-						"or saved")
-			sums = dict()
+				job.status = 'WAITING'
+				stack.append(job)
 
-		# Update Job Status' for jobs that have matching MD5's
-		for job in self.jobs:
-			ready = True
-			print(job)
-			for out in job.outputs:
-				p = out.path
-				if p not in sums or not out.md5sum or sums[p] != out.md5sum:
-					ready = False
+		# (lazy mode) producers in earlier batches that haven't finished
+		for job in jobs:
+			if job.status == 'SUCCESS' and any(dep.status != 'SUCCESS'
+					for dep in Scheduler.producers(job)):
+				job.status = 'WAITING'
+				stack.append(job)
+
+		batch = set(jobs)
+		while stack:
+			for user in Scheduler.consumers(stack.pop()):
+				if user.status == 'SUCCESS' and user in batch:
+					user.status = 'WAITING'
+					stack.append(user)
+
+		self.adoptSignatures()
+
+	def adoptSignatures(self):
+		""" Store the signatures upToDate() took from jobs """
+		if self.adopted:
+			adopted, self.adopted = self.adopted, dict()
+			self.state.adopt(adopted)
+
+	def materialize(self):
+		""" Generates batches of at most LAZYBATCH new jobs, expanding the
+		Generators one job at a time. The outputs of each batch are
+		fingerprinted and compared with the state file before it is
+		returned, along with the index of the first Generator that may have
+		jobs left (see producible). Jobs are not kept in self.jobs, once
+		run() is done with them only the Files refer to them. """
+		expanding = [0]
+		def iterjobs():
+			for ii, bb in enumerate(self.geners):
+				expanding[0] = ii
+				yield from bb.iterJobs(self.files, self.variables)
+			expanding[0] = len(self.geners)
+
+		jobs = iterjobs()
+		while True:
+			batch = list(itertools.islice(jobs, LAZYBATCH))
+			if not batch:
+				return
+
+			# outputs, and inputs that haven't been fingerprinted (for
+			# Job.signature)
+			flist = dict.fromkeys(f for job in batch for f in job.outputs)
+			flist.update((f, None) for job in batch for f in job.inputs
+					if f.md5sum is None)
+			newsums, stats = scan_files([f.path for f in flist], self.fpmode,
+					self.fpcache, self.nthreads)
+			for f in flist:
+				f.md5sum = newsums.get(f.path)
+			self.updateStatus(batch)
+			yield batch, expanding[0]
+
+	def scan(self, flist):
+		""" Fingerprint flist (paths or FileIndex.bydir()) with
+		scan_files(), reporting progress and
+		keeping timing metrics in self.scanstats """
+		last = [time.time()]
+		def progress(ndone, ntotal):
+			now = time.time()
+			if now - last[0] > 1 or ndone == ntotal:
+				last[0] = now
+				log.info("Scanned %i/%i directories", ndone, ntotal)
+
+		hits = self.fpcache.hits if self.fpcache else 0
+		sums, stats = scan_files(flist, self.fpmode, self.fpcache,
+				self.nthreads, progress)
+		if self.fpcache:
+			stats['cachehits'] = self.fpcache.hits - hits
+		self.scanstats = stats
+		log.info("Fingerprinted %i of %i files in %i directories in %.2fs",
+				stats['found'], stats['files'], stats['directories'],
+				stats['seconds'])
+		return sums
+
+	def run(self, executor = None, chain = False, maxrunning = None):
+		""" Run every WAITING job, commands are handed to executor (an
+		Executor, DrmaaExecutor by default). If chain is set the commands of
+		a job are run by one generated script (see chainScript) rather than
+		submitted one at a time. At most maxrunning jobs are submitted at
+		once, if given. """
+		self.startRun(executor, chain, maxrunning)
+		try:
+			while self.busy():
+				if self.expandable():
+					self.addBatch(next(self.pending, None))
+				self.step()
+				if not self.running:
+					continue
+
+				# Wait for running jobs to finish, collecting every job that
+				# has finished. Don't wait if there are more jobs to expand.
+				if self.expandable():
+					completed = self.executor.harvest(0)
+				else:
+					completed = self.executor.harvest()
+				for pid, exitstatus in completed:
+					self.complete(pid, exitstatus)
+
+			# Update MD5 Sums
+			self.refresh(self.scan(self.files.bydir()))
+			self.checkStuck()
+		finally:
+			self.stopRun()
+
+	async def run_async(self, executor = None, chain = False,
+			maxrunning = None, control = None):
+		""" run() as a coroutine. Waiting for jobs, expanding jobs (lazy
+		mode) and fingerprinting files don't block the event loop, so
+		several trees (or anything else) can be run from one thread, each
+		with its own executor:
+
+			await asyncio.gather(a.run_async(exa), b.run_async(exb))
+
+		With a Control the run doesn't end when there is nothing left to do
+		(failed jobs may be retried) but once the Control is stopped and the
+		running jobs are done. """
+		self.startRun(executor, chain, maxrunning)
+		try:
+			while self.busy() or control:
+				if control and control.stopping and not (self.running or
+						self.startqueue):
 					break
-
-			if ready:
-				job.status = 'SUCCESS'
-				print("All Outputs Exist for Job: %s\n" % str(job.cmds))
+				if self.expandable():
+					self.addBatch(await asyncio.to_thread(next, self.pending,
+							None))
+				self.step()
+				if not self.running:
+					if control and (self.paused or not self.busy()):
+						await control.wait()
+					else:
+						await asyncio.sleep(0)
+					continue
+
+				# Come back now and then for changes made through control
+				if self.expandable():
+					completed = await self.executor.harvest_async(0)
+				elif control:
+					completed = await self.executor.harvest_async(POLLTIME)
+				else:
+					completed = await self.executor.harvest_async()
+
+				# Fingerprint the outputs of the jobs that are done (which
+				# may mean reading them) in a worker thread
+				sums = None
+				if self.state:
+					sums = await asyncio.to_thread(self.outputSums,
+							self.finishing(completed))
+				for pid, exitstatus in completed:
+					self.complete(pid, exitstatus, sums)
+
+			# Update MD5 Sums
+			self.refresh(await asyncio.to_thread(self.scan,
+					self.files.bydir()))
+			if not control:
+				self.checkStuck()
+		finally:
+			self.stopRun()
+
+	async def serve(self, path, executor = None, chain = False,
+			maxrunning = None):
+		""" run_async(), controlled through a UNIX socket at path (see
+		Control) until told to stop """
+		control = Control(self, path)
+		await control.start()
+		try:
+			await self.run_async(executor, chain, maxrunning, control)
+		finally:
+			await control.close()
+
+	def startRun(self, executor, chain, maxrunning):
+		""" Set up the state of a run, see run() """
+		if executor is None:
+			executor = DrmaaExecutor(self.workdir)
+		executor.start()
+		self.executor = executor
+		self.chain = chain
+		self.maxrunning = maxrunning
+		self.chains = dict() # Job -> script running its commands
+
+		# Jobs move from the scheduler's ready queue to startqueue, startqueue
+		# to running, and running back to startqueue (next command) or to the
+		# scheduler as finished. Only the users of a finished job's outputs
+		# are revisited.
+		self.lazy = self.pending is not None
+		self.unresolved = dict() # jobs that succeeded, not let go of yet
+		self.forgotten = dict() # jobs to drop from File.users (compact)
+		self.dirty = dict() # Files to drop them from
+		if self.lazy:
+			self.sched = Scheduler()
+			self.sched.producible = self.producible
+			self.sched.hold = True
+		else:
+			self.prioritize(self.jobs)
+			self.sched = Scheduler(self.jobs)
+		self.running = {}   # jobs that are currently running
+		self.startqueue = [] # Jobs the need to be started
+
+		# Jobs running (of all their commands) per Generator, and jobs held
+		# back because their Generator was at its limit
+		self.genrunning = collections.Counter()
+		self.held = dict()
+		self.metrics = Metrics()
+		self.commands = dict() # pid -> Metrics record of running commands
+
+		# For status() and retry(): jobs that failed, number of jobs
+		# finished by outcome and when the jobs of the last minute finished
+		self.failed = []
+		self.tally = collections.Counter()
+		self.recent = collections.deque()
+		self.runstart = time.time()
+
+	def estimate(self, job, means = None):
+		""" Estimated seconds job will take: its runtime the last time it
+		succeeded, the runtime given for its Generator, the mean (in means)
+		of the runtimes of the Generator's other jobs or DEFAULTRUNTIME """
+		runtime = self.runtimes.get(StateStore.jobkey(job))
+		if runtime is None and job.parent:
+			runtime = job.parent.runtime
+			if runtime is None and means:
+				runtime = means.get(job.parent)
+		if runtime is None:
+			runtime = DEFAULTRUNTIME
+		return runtime
+
+	def means(self, jobs):
+		""" Mean runtime (from the history) of the jobs of each Generator,
+		for estimate() """
+		totals = dict()
+		for job in jobs:
+			runtime = self.runtimes.get(StateStore.jobkey(job))
+			if runtime is not None and job.parent:
+				total = totals.setdefault(job.parent, [0, 0])
+				total[0] += runtime
+				total[1] += 1
+		return {gen: t / n for gen, (t, n) in totals.items()}
+
+	def prioritize(self, jobs):
+		""" Set the priority of each of jobs to the estimated time of the
+		longest chain of jobs starting with it, so that long chains are
+		started first. Jobs that are already done take no time. """
+		means = self.means(jobs)
+
+		# From the last jobs back, each job once all the users of its
+		# outputs are done
+		nusers = {job: 0 for job in jobs}
+		for job in jobs:
+			for dep in Scheduler.producers(job):
+				if dep in nusers:
+					nusers[dep] += 1
+		stack = [job for job, n in nusers.items() if n == 0]
+		for job in jobs:
+			job.priority = 0
+		while stack:
+			job = stack.pop()
+			after = max((user.priority for user in Scheduler.consumers(job)),
+					default = 0)
+			if job.status == 'SUCCESS':
+				job.priority = after
 			else:
-				job.status = 'WAITING'
+				job.priority = after + self.estimate(job, means)
+			for dep in Scheduler.producers(job):
+				if dep in nusers:
+					nusers[dep] -= 1
+					if nusers[dep] == 0:
+						stack.append(dep)
+
+	def stuck(self):
+		""" Jobs that are still waiting, which once nothing is left to run
+		means that they wait on each other (a cycle) """
+		if self.lazy:
+			jobs = dict.fromkeys(f.genr for f in self.files.values()
+					if f.genr is not None)
+		else:
+			jobs = self.jobs
+		return [job for job in jobs if job.status == 'WAITING']
+
+	def checkStuck(self):
+		""" Raise InputError if jobs were left waiting at the end of a run
+		(see stuck) """
+		if not self.sched.unfinished:
+			return
+		stuck = self.stuck()
+		log.error("The Following Jobs have Unresolved Dependencies!%s",
+				"".join(str(job) for job in stuck))
+		raise InputError("run", "Error! Unresolved dependencies (a cycle?) "
+				"between %i jobs" % len(stuck))
+
+	def stopRun(self):
+		self.executor.stop()
+		self.metrics.report()
+		if self.state:
+			self.state.commands(self.metrics.records)
+
+	def status(self):
+		""" Numbers of jobs by status, how fast they are finishing and how
+		many are queued, as a dict for Control. In lazy mode only the jobs
+		that have been expanded are known. """
+		if self.lazy:
+			counts = collections.Counter(job.status for job in
+					self.failedJobs())
+			counts['RUNNING'] = len(self.running) + len(self.startqueue)
+			counts['WAITING'] = self.sched.unfinished - counts['RUNNING']
+			counts['SUCCESS'] = self.tally['SUCCESS']
+		else:
+			counts = collections.Counter(job.status for job in self.jobs)
+
+		now = time.time()
+		while self.recent and self.recent[0] < now - 60:
+			self.recent.popleft()
+		return {'jobs' : {status : counts[status] for status in ('WAITING',
+					'RUNNING', 'SUCCESS', 'FAIL', 'DEPFAIL')},
+				'finished' : sum(self.tally.values()),
+				'seconds' : now - self.runstart,
+				'lastminute' : len(self.recent),
+				'ready' : len(self.sched.ready),
+				'held' : sum(len(held) for held in self.held.values()),
+				'running' : len(self.running) + len(self.startqueue),
+				'expanding' : self.pending is not None,
+				'paused' : self.paused,
+				'maxrunning' : self.maxrunning}
+
+	def failedJobs(self):
+		""" The jobs that failed in this run and those downstream of them
+		that didn't run because they did (DEPFAIL) """
+		jobs = dict.fromkeys(self.failed)
+		stack = list(self.failed)
+		while stack:
+			for user in Scheduler.consumers(stack.pop()):
+				if user.status == 'DEPFAIL' and user not in jobs:
+					jobs[user] = None
+					stack.append(user)
+		return list(jobs)
+
+	def retry(self):
+		""" Queue the jobs that failed again, along with the jobs that
+		didn't run because they did. Returns how many were queued. """
+		jobs = self.failedJobs()
+		self.failed = []
+		self.sched.retry(jobs)
+		return len(jobs)
+
+	def busy(self):
+		""" Whether the run has anything left to do """
+		return bool(self.sched.ready or self.startqueue or self.running or
+				self.pending)
+
+	def expandable(self):
+		""" Whether to expand another batch of jobs (lazy mode): only if
+		there are fewer than LAZYBATCH ready, room to start them and fewer
+		than LAZYWINDOW unfinished jobs, or nothing else to do """
+		if not self.pending:
+			return False
+		ready = self.sched.ready
+		if not (ready or self.running or self.startqueue):
+			return True
+		if len(ready) >= LAZYBATCH:
+			return False
+		if ready and (self.paused or self.maxrunning and
+				len(self.running) + len(self.startqueue) >= self.maxrunning):
+			return False
+		return self.sched.unfinished < LAZYWINDOW
+
+	def addBatch(self, batch):
+		""" Add a batch of jobs from materialize() to the scheduler, None
+		means there are no more """
+		if batch is None:
+			self.pending = None
+			self.expanding = len(self.geners)
+			self.sched.close()
+			for job in list(self.unresolved):
+				self.letGo(job)
+			self.unresolved = dict()
+			return
+
+		batch, expanding = batch
+		advanced = expanding != self.expanding
+		self.expanding = expanding
+		for job in batch:
+			job.priority = self.estimate(job)
+			self.sched.add(job)
+			if job.status == 'SUCCESS':
+				self.letGo(job)
+
+		# Files the Generators left can't make are sources from now on
+		if advanced:
+			self.sched.recheck()
+			for job in list(self.unresolved):
+				self.letGo(job)
+
+	def producible(self, f):
+		""" (lazy mode) Whether a Generator that hasn't been expanded yet
+		may make f, which no job makes so far """
+		return any(gen.mayMake(f.path) for gen in self.geners[self.expanding:])
+
+	def settled(self, job):
+		""" (lazy mode) Whether no job expanded later can make job run again:
+		each of its inputs is made by a job that has been let go of, or by
+		no job at all """
+		if not self.pending:
+			return True
+		for f in job.inputs:
+			if f.genr is DONE:
+				continue
+			if f.genr is None and not self.producible(f):
+				continue
+			return False
+		return True
+
+	def letGo(self, job):
+		""" (lazy mode) Forget a job that succeeded if it is settled, and
+		then the jobs using its outputs that are settled now, otherwise
+		hold on to it: a job added later that makes its inputs would have to
+		run it again (see Scheduler.invalidate), so the jobs using its
+		outputs wait until it is settled (see Scheduler.settle) """
+		stack = [job]
+		while stack:
+			job = stack.pop()
+			if job.status != 'SUCCESS':
+				# remade since it was held on to
+				self.unresolved.pop(job, None)
+			elif not self.settled(job):
+				self.unresolved[job] = None
+			else:
+				self.unresolved.pop(job, None)
+				self.sched.settle(job)
+				stack.extend(user for user in Scheduler.consumers(job)
+						if user in self.unresolved)
+				self.forget(job)
+
+	def forget(self, job):
+		""" (lazy mode) Let go of a job that succeeded, so that only the
+		jobs that haven't finished are kept: the Files it made refer to
+		DONE instead and it is dropped from the users of the Files it used
+		(a batch of jobs at a time, see compact) """
+		job.cmds = []
+		job.running_cmd = None
+		for f in job.outputs:
+			f.genr = DONE
+		self.forgotten[job] = None
+		self.dirty.update(dict.fromkeys(job.inputs))
+		if len(self.forgotten) >= LAZYBATCH:
+			self.compact()
+
+	def compact(self):
+		""" Drop the jobs given to forget() from File.users """
+		forgotten = self.forgotten
+		for f in self.dirty:
+			f.users = [user for user in f.users if user not in forgotten] \
+					or ()
+		self.forgotten = dict()
+		self.dirty = dict()
+
+	def refresh(self, sums):
+		""" Store new fingerprints {path: fingerprint} in the files """
+		for kk, vv in sums.items():
+			self.files[kk].md5sum = vv
+
+	def step(self):
+		""" Submit the jobs that are ready. Expanding more jobs (lazy mode,
+		see expandable) is up to the caller, so that run_async() can do it
+		in a worker thread. """
+		sched = self.sched
+		running = self.running
+		startqueue = self.startqueue
+
+		## Move Any Jobs that we can to startqueue
+		started = []
+		while sched.ready and not self.paused and (not self.maxrunning or
+				len(running) + len(startqueue) < self.maxrunning):
+			job = sched.pop()
+			if job is None:
+				break
+			log.log(TRACE, "Job Ready to Run:%s", job)
+			if not job.cmds:
+				sched.finish(job, True)
+				if self.lazy:
+					self.letGo(job)
+				continue
 
-	def run(self):
-		# Set up Grid Engine
-		self.gridengine = drmaa.Session()
-		self.gridengine.initialize()
-		template = self.gridengine.createJobTemplate()
-
-		# Queues. Jobs move from waitqueue to startqueue, startqueue to either
-		# running or donequeue, and running to startqueue or (in case of error)
-		waitqueue = [j for j in self.jobs if j.status == 'WAITING'] # jobs with unmet depenendencies
-		running = {}   # jobs that are currently running
-		donequeue = [j for j in self.jobs if j.status == 'SUCCESS']  # jobs that are done
-		startqueue = [] # Jobs the need to be started
-		while waitqueue or running:
-			## Move Any Jobs that we can to startqueue
-			for job in waitqueue:
-				# check if inputs have been produced
-				ready = True
-				for inp in job.inputs:
-					if inp.genr.status == 'FAIL' or inp.genr.status == 'DEPFAIL':
-						ready = False
-						job.status = 'DEPFAIL'
-						donequeue.append(job)
-						del(waitqueue[waitqueue.index(job)])
-						if VERBOSE > 1:
-							print("Dependency Failed for:\n%s"%str(job))
-						break
-					elif inp.genr.status != 'SUCCESS':
-						ready = False
-				if ready:
-					# Change to Queue State and Fill Command Queue
-					if VERBOSE > 4:
-						print("Job Ready to Run:\n%s"%str(job))
-					job.status = 'RUNNING'
-					job.cmdqueue = [cmd for cmd in job.cmds]
-					startqueue.append(job)
-					del(waitqueue[waitqueue.index(job)])
-
-			## Start Jobs
-			for job in startqueue:
-				## Get the Next Job (If there is one)
+			# Inputs remade by upstream jobs may not have changed
+			if self.upToDate(job):
+				log.debug("Job Up To Date: %s", job.cmds)
+				sched.finish(job, True)
+				if self.lazy:
+					self.letGo(job)
+				continue
+
+			# Wait for another job of the Generator to finish
+			gen = job.parent
+			if gen and gen.limit and self.genrunning[gen] >= gen.limit:
+				self.held.setdefault(gen, collections.deque()).append(job)
+				continue
+			self.genrunning[gen] += 1
 
+			# Change to Queue State and Fill Command Queue
+			job.status = 'RUNNING'
+			if self.chain and len(job.cmds) > 1:
+				self.chains[job] = self.chainScript(job)
+				job.cmdqueue = [shlex.join(['/bin/sh', self.chains[job]])]
+			else:
+				job.cmdqueue = [cmd for cmd in job.cmds]
+			startqueue.append(job)
+			started.append(job)
+
+		# Forget the outputs of the jobs before touching them, so that if
+		# we are killed they are rerun next time
+		if started and self.state:
+			self.state.started(started)
+
+		## Start Jobs, the next commands of jobs from the same Generator
+		## differ only in variable values so they are submitted together
+		groups = dict()
+		for job in startqueue:
+			key = (id(job.parent), len(job.cmds) - len(job.cmdqueue))
+			groups.setdefault(key, []).append(job)
+
+		for group in groups.values():
+			cmds = []
+			for job in group:
 				# Start the next job
 				cmd = job.cmdqueue.pop(0)
-				if VERBOSE > 1:
-					print("Submitting Job:\n%s " % str(cmd))
-				cmd = shlex.split(cmd)
-				template.remoteCommand = cmd[0]
-				template.args = cmd[1:]
-				job.running_cmd = [template.remoteCommand]+template.args
-				job.pid = self.gridengine.runJob(template)
-				if VERBOSE > 2:
-					print("PID: %s" % job.pid)
-				job.status = 'RUNNING'
+				log.debug("Submitting Job: %s", cmd)
+				job.running_cmd = shlex.split(cmd)
+				cmds.append(job.running_cmd)
+
+			queued = time.time()
+			pids = self.executor.submitBulk(cmds)
+			submitted = time.time()
+			for job, pid in zip(group, pids):
+				self.commands[pid] = {'job' : StateStore.jobkey(job),
+						'generator' : Metrics.genkey(job.parent),
+						'cmd' : len(job.cmds) - len(job.cmdqueue) - 1,
+						'queued' : queued, 'submitted' : submitted}
+				job.pid = pid
+				log.debug("PID: %s", job.pid)
+				self.events.emit('submitted', job, pid=job.pid,
+						cmd=job.running_cmd)
 				running[job.pid] = job
-				changed = True
-
-			# Clear the start queue
-			startqueue = []
-
-			# Wait for a running job to finish
-			jobinfo = self.gridengine.wait(
-					drmaa.Session.JOB_IDS_SESSION_ANY,
-					drmaa.Session.TIMEOUT_WAIT_FOREVER)
-			job = running[jobinfo.jobId]
-			del(running[jobinfo.jobId])
-			print("Job:\n%s\n Finished with status: %s " % (job.running_cmd,
-					jobinfo.exitStatus))
-			if jobinfo.exitStatus == 0:
-
-				if job.cmdqueue:
-					startqueue.append(job)
-				else:
-					# No More Jobs Left, Check Outputs
-					job.status = 'SUCCESS'
-					donequeue.append(job)
-			else:
-				print("Job Failed: %s\n" % job)
-				print("For Command: %s " % job.running_cmd)
-				job.status = 'FAIL'
-				donequeue.append(job)
 
-		# Update MD5 Sums
-		sums = md5sum([f.path for f in self.files.values()])
-		for kk, vv in sums.items():
-			self.files[kk].md5sum = vv
+		# Clear the start queue
+		startqueue.clear()
+
+	def finishing(self, completed):
+		""" The jobs of the finished commands completed [(pid, exitstatus)]
+		that are done, whose outputs complete() fingerprints """
+		jobs = []
+		for pid, exitstatus in completed:
+			job = self.running.get(pid)
+			if exitstatus == 0 and job is not None and not job.cmdqueue:
+				jobs.append(job)
+		return jobs
 
-		self.gridengine.deleteJobTemplate(template)
-		self.gridengine.exit()
+	def outputSums(self, jobs):
+		""" Fingerprints {path: fingerprint} of the outputs of jobs, for
+		complete() """
+		if not self.state or not jobs:
+			return dict()
+		sums, stats = scan_files([f.path for job in jobs for f in job.outputs],
+				self.fpmode, self.fpcache, self.nthreads)
+		return sums
+
+	def complete(self, pid, exitstatus, sums = None):
+		""" Handle a finished command: queue the next command of its job or
+		tell the scheduler that the job is done. sums are the fingerprints
+		of the outputs, if they have been taken already (see outputSums) """
+		job = self.running.pop(pid)
+		sched = self.sched
+		log.debug("Job: %s Finished with status: %s", job.running_cmd,
+				exitstatus)
+
+		# Timings and resource usage. If the executor doesn't know when the
+		# command ran, it started when submitted and finished now.
+		record = self.commands.pop(pid)
+		record.update(self.executor.resources(pid))
+		record.setdefault('finished', time.time())
+		record.setdefault('started', record['submitted'])
+		record['exitstatus'] = exitstatus
+		self.metrics.add(job, record)
+		if job in self.chains:
+			failed = self.chainDone(self.chains.pop(job))
+			if failed is not None:
+				job.running_cmd = shlex.split(job.cmds[failed])
+
+		if exitstatus == 0:
+
+			if job.cmdqueue:
+				self.startqueue.append(job)
+				return
+			else:
+				# No More Jobs Left, Check Outputs
+				if self.state:
+					if sums is None:
+						sums = fingerprint([f.path for f in job.outputs],
+								self.fpmode, self.fpcache)
+					else:
+						sums = {f.path: sums[f.path] for f in job.outputs
+								if f.path in sums}
+					for f in job.outputs:
+						f.md5sum = sums.get(f.path)
+					self.state.finished(job, sums, job.signature(),
+							self.metrics.jobtimes.get(job))
+				sched.finish(job, True)
+				self.tally['SUCCESS'] += 1
+				self.events.emit('finished', job, pid=pid)
+		else:
+			log.error("Job Failed: %s\nFor Command: %s", job,
+					job.running_cmd)
+			if self.state:
+				self.state.failed(job)
+			sched.finish(job, False)
+			self.failed.append(job)
+			self.tally['FAIL'] += 1
+			self.events.emit('failed', job, pid=pid, cmd=job.running_cmd,
+					exitstatus=exitstatus)
+		self.recent.append(time.time())
+
+		# Let a held back job of the same Generator go
+		self.metrics.jobtimes.pop(job, None)
+		self.genrunning[job.parent] -= 1
+		if self.held.get(job.parent):
+			sched.push(self.held[job.parent].popleft())
+
+		# In lazy mode don't keep jobs that succeeded around once nothing
+		# can make them run again (failed jobs may be retried)
+		if self.lazy and job.status == 'SUCCESS':
+			self.letGo(job)
+
+	def chainScript(self, job):
+		""" Writes a shell script to the work directory that runs the
+		commands of job in order and stops at the first one that fails. The
+		number of the failed command is written to SCRIPT.failed, see
+		chainDone() """
+		os.makedirs(self.workdir, exist_ok=True)
+		fd, script = tempfile.mkstemp(prefix='chain-', suffix='.sh',
+				dir=self.workdir)
+		script = os.path.abspath(script)
+		failed = shlex.quote(script + '.failed')
+		with os.fdopen(fd, "w") as f:
+			f.write("#!/bin/sh\n# Commands of one ent job, stops at the first "
+					"failure\n")
+			for ii, cmd in enumerate(job.cmds):
+				f.write("%s || { rc=$?; echo %i > %s; exit $rc; }\n" % (
+						shlex.join(shlex.split(cmd)), ii, failed))
+		return script
+
+	def chainDone(self, script):
+		""" Removes a script written by chainScript, returns the index of the
+		command that failed (None if none did) """
+		failed = None
+		try:
+			with open(script + '.failed', "r") as f:
+				failed = int(f.read())
+			os.remove(script + '.failed')
+		except (IOError, ValueError):
+			pass
+		try:
+			os.remove(script)
+		except OSError as e:
+			pass
+		return failed
 
 	def genmakefile(self, filename):
 
 		# Identify Files without Generators
 		rootfiles = []
 		for k,v in self.files.items():
-			print(k)
-			print(v)
+			log.debug("file: %s", v)
 			if v.genr == None:
-				print("no generator")
+				log.debug("no generator")
 				v.finished = True
 				rootfiles.append(k)
 
@@ -705,18 +1842,75 @@ class Ent:
 						cmd = " ".join(re.split("\s+", cmd))
 						cmd = expand_args(cmd, job.inputs, job.outputs)
 					except InputError as e:
-						print("While Expanding Command %s" % cmd)
-						print(e.msg)
+						log.error("While Expanding Command %s\n%s", cmd, e.msg)
 						sys.exit(-1)
 					f.write('\n\t%s' % cmd)
 				f.write('\n')
 
-	def simulate(self, statefile = None):
+	def makespan(self, jobs, slots = None, means = None):
+		""" Estimated seconds to run jobs with at most slots (None for no
+		limit) running at once, starting them in the order step() would:
+		longest chain first (prioritize() must have been called) and no
+		more than the limit of their Generator at once. Jobs that are
+		already done take no time or slot. """
+		waiting = dict()
+		ready = []
+		for n, job in enumerate(jobs):
+			waiting[job] = len(Scheduler.producers(job))
+			if waiting[job] == 0:
+				heapq.heappush(ready, (-job.priority, n, job))
+
+		count = itertools.count(len(jobs))
+		running = [] # heap of (finish time, n, job)
+		genrunning = collections.Counter()
+		held = dict()
+		now = 0
+		while ready or running:
+			finished = []
+			while ready and (slots is None or len(running) < slots):
+				_, n, job = heapq.heappop(ready)
+				gen = job.parent
+				if job.status == 'SUCCESS':
+					finished.append(job)
+					break
+				if gen and gen.limit and genrunning[gen] >= gen.limit:
+					held.setdefault(gen, collections.deque()).append((n, job))
+					continue
+				genrunning[gen] += 1
+				heapq.heappush(running, (now + self.estimate(job, means), n,
+					job))
+
+			if not finished:
+				if not running:
+					break
+				now, n, job = heapq.heappop(running)
+				finished.append(job)
+				genrunning[job.parent] -= 1
+				if held.get(job.parent):
+					n, job2 = held[job.parent].popleft()
+					heapq.heappush(ready, (-job2.priority, n, job2))
+
+			for user in Scheduler.consumers(finished[0]):
+				if user in waiting:
+					waiting[user] -= 1
+					if waiting[user] == 0:
+						heapq.heappush(ready, (-user.priority, next(count),
+							user))
+		return now
+
+	def simulate(self, slots = None):
+		""" Print what running would do, without running anything: the Files
+		that must already exist, the jobs that are up to date, the jobs to
+		run (in an order they could run in), how many could run at once at
+		each level of the graph, and the estimated length of the longest
+		chain and of the whole run with slots (or a range of numbers of)
+		jobs at once. Estimates use the runtimes of previous runs, see
+		estimate(). """
 
 		# Identify Files without Generators
 		rootfiles = []
 		for k,v in self.files.items():
-			print("file: ", k, v, v.genr)
+			log.debug("file: %s %s", v, v.genr)
 			if v.genr == None:
 				v.finished = True
 				rootfiles.append(k)
@@ -726,49 +1920,1569 @@ class Ent:
 		for f in rootfiles:
 			print(f)
 
-		finished = set()
-		outqueue = []
-		skipqueue = []
-		rqueue = [j for j in self.jobs]
-		while len(rqueue) > 0:
-			done = []
-			for i, job in enumerate(rqueue):
-				# Check if all the inputs are ready
-				ready = True
-				for infile in job.inputs:
-					if infile.path not in finished:
-					   ready = False
-					   break
-
-				if ready and job.status != 'SUCCESS':
-					for out in job.outputs:
-						finished.add(out.path)
-					outqueue.append(' && '.join(job.cmds))
-					done.append(i)
-				if ready and job.status == 'SUCCESS':
-					for out in job.outputs:
-						finished.add(out.path)
-					skipqueue.append(' && '.join(job.cmds))
-					done.append(i)
-
-			# In the Real Runner we will also have to check whether there
-			# are processes that are waiting
-			if len(done) > 0:
-				done.reverse()
-				for i in done:
-					del(rqueue[i])
-			else:
-				print("Error The Following Job has Unresolved Dependencies!")
-				for rr in rqueue:
-					print(rr)
-				raise InputError("Unresolved Dependencies")
+		# Order the jobs so that each comes after those that make its inputs
+		# (Kahn's algorithm), the level of each is the number of jobs to run
+		# in the longest chain ending with it
+		waiting = dict()
+		for job in self.jobs:
+			waiting[job] = len(Scheduler.producers(job))
+		order = [job for job, n in waiting.items() if n == 0]
+		level = dict.fromkeys(order, 0)
+		for job in order:
+			if job.status != 'SUCCESS':
+				level[job] += 1
+			for user in Scheduler.consumers(job):
+				level[user] = max(level.get(user, 0), level[job])
+				waiting[user] -= 1
+				if waiting[user] == 0:
+					order.append(user)
+
+		if len(order) < len(self.jobs):
+			rest = [job for job, n in waiting.items() if n > 0]
+			log.error("The Following Jobs have Unresolved Dependencies!%s",
+					"".join(str(rr) for rr in rest))
+			raise InputError("simulate", "Error! Unresolved dependencies "
+					"(a cycle?) between %i jobs" % len(rest))
 
 		print("Jobs that are up to date")
-		for q in skipqueue:
-			print(q)
+		for job in order:
+			if job.status == 'SUCCESS':
+				print(' && '.join(job.cmds))
 		print("Jobs to Run")
-		for q in outqueue:
-			print(q)
+		torun = [job for job in order if job.status != 'SUCCESS']
+		for job in torun:
+			print(' && '.join(job.cmds))
+		if not torun:
+			return
+
+		widths = collections.Counter(level[job] for job in torun)
+		print("Jobs that can Run at Once")
+		print("%8s %8s" % ("level", "jobs"))
+		for ll in sorted(widths):
+			print("%8i %8i" % (ll, widths[ll]))
+
+		# Estimated times
+		means = self.means(order)
+		self.prioritize(order)
+		print("Longest chain: %i jobs, %.1f seconds" % (max(widths),
+			max(job.priority for job in order)))
+		if slots:
+			counts = [slots]
+		else:
+			counts = [1]
+			while counts[-1] < max(widths.values()):
+				counts.append(counts[-1] * 2)
+		print("Estimated time to run")
+		print("%8s %10s" % ("slots", "seconds"))
+		for nn in counts:
+			print("%8i %10.1f" % (nn, self.makespan(order, nn, means)))
+
+###############################################################################
+# Master
+###############################################################################
+class Master:
+	"""
+	Runs several trees (Ents) together over one executor (one DRMAA session
+	rather than one per tree). At most maxrunning jobs run at once across
+	all the trees, shared fairly: each tree that has jobs to run may run an
+	equal part of them, and what a tree doesn't need is split between the
+	others (max-min fair share, see share()). Load the trees with one FingerprintCache,
+	with its known set, so that the files they share are only fingerprinted
+	once:
+
+		fpcache.known = dict()
+		ents = [Ent(script, state, 'mtime', fpcache) for ...]
+		fpcache.known = None
+		Master(ents).run(executor, maxrunning = 100)
+
+	Each tree is still its own graph, a file made by one tree and used by
+	another is not waited for.
+	"""
+
+	def __init__(self, ents):
+		self.ents = ents
+		self.executor = None
+		self.maxrunning = None
+		self.owners = dict() # pid -> Ent that submitted it
+
+	def run(self, executor = None, chain = False, maxrunning = None):
+		""" Run every WAITING job of every tree, see Ent.run. maxrunning
+		defaults to the number of commands the executor runs at once, so
+		that the trees share it """
+		if executor is None:
+			executor = DrmaaExecutor(self.ents[0].workdir)
+		executor.start()
+		self.executor = executor
+		self.maxrunning = maxrunning or executor.njobs
+		try:
+			for ent in self.ents:
+				ent.startRun(TreeExecutor(self, ent), chain, None)
+
+			while any(ent.busy() for ent in self.ents):
+				self.share()
+				for ent in self.ents:
+					if ent.expandable():
+						ent.addBatch(next(ent.pending, None))
+					if ent.busy():
+						ent.step()
+				if not self.owners:
+					continue
+
+				# Wait for running jobs to finish, unless there are more jobs
+				# to expand
+				if any(ent.expandable() for ent in self.ents):
+					completed = executor.harvest(0)
+				else:
+					completed = executor.harvest()
+				for pid, exitstatus in completed:
+					self.owners.pop(pid).complete(pid, exitstatus)
+
+			# Update MD5 Sums
+			for ent in self.ents:
+				ent.refresh(ent.scan(ent.files.bydir()))
+			for ent in self.ents:
+				ent.checkStuck()
+		finally:
+			for ent in self.ents:
+				if ent.sched:
+					ent.stopRun()
+			executor.stop()
+
+	def share(self):
+		""" Split maxrunning between the trees by setting the
+		Ent.maxrunning of each (paused if it gets none). A tree wants the
+		jobs it is running and those that are ready, or any number while it
+		still has jobs to expand. """
+		if not self.maxrunning:
+			return
+		wants = dict()
+		for ent in self.ents:
+			if ent.pending:
+				wants[ent] = self.maxrunning
+			else:
+				wants[ent] = (len(ent.running) + len(ent.startqueue) +
+						len(ent.sched.ready))
+
+		# The trees that want least first, what they don't take is split
+		# between the rest
+		shares = dict()
+		left = self.maxrunning
+		order = sorted(self.ents, key = lambda ent: wants[ent])
+		ii = 0
+		while ii < len(order) and wants[order[ii]] <= left // (len(order) - ii):
+			shares[order[ii]] = wants[order[ii]]
+			left -= wants[order[ii]]
+			ii += 1
+		for ent in order[ii:]:
+			shares[ent] = left // (len(order) - ii)
+		left -= sum(shares[ent] for ent in order[ii:])
+
+		# Slots left over from rounding go to the trees that have finished
+		# the fewest jobs
+		for ent in sorted(order, key = lambda ent: sum(ent.tally.values())):
+			if left and shares[ent] < wants[ent]:
+				shares[ent] += 1
+				left -= 1
+
+		for ent, share in shares.items():
+			ent.paused = share == 0
+			ent.maxrunning = share or None
+
+def run_task(taskfile, index = None):
+	""" Runs one command of a task file written by
+	DrmaaExecutor.submitBulk, in place of this process. index is 1 based,
+	if it isn't given the array task id set by the grid engine is used """
+	if index is None:
+		for var in TASKID_VARS:
+			if os.environ.get(var, '').isdigit():
+				index = int(os.environ[var])
+				break
+		else:
+			log.error("No task index, none of %s is set", TASKID_VARS)
+			return 2
+
+	with open(taskfile, "r") as f:
+		line = next(itertools.islice(f, index-1, None), None)
+	if line is None:
+		log.error("%s has no task %i", taskfile, index)
+		return 2
+
+	cmd = json.loads(line)
+	try:
+		os.execvp(cmd[0], cmd)
+	except OSError as e:
+		log.error("Error running %s: %s", cmd, e)
+		return 127
+
+###############################################################################
+# JSON Stream
+###############################################################################
+class JsonStream:
+	"""
+	Reads a JSON document a piece at a time, so that only the value being
+	read has to be in memory rather than the whole document:
+
+		stream = JsonStream(f)
+		for key in stream.members():   # keys of the top level object
+			if key == 'list':
+				for ii in stream.items():
+					item = stream.value()
+			else:
+				stream.value()         # every member/item must be read
+
+	Errors are raised as json.JSONDecodeError.
+	"""
+
+	def __init__(self, f, blocksize = 1<<20):
+		self.f = f
+		self.blocksize = blocksize
+		self.buf = ""
+		self.pos = 0
+		self.eof = False
+		self.decoder = json.JSONDecoder()
+
+	def fill(self, size = None):
+		""" Read more of the file, returns False at the end of it """
+		if self.eof:
+			return False
+		data = self.f.read(size or self.blocksize)
+		if not data:
+			self.eof = True
+			return False
+		if self.pos > len(self.buf) // 2:
+			self.buf = self.buf[self.pos:]
+			self.pos = 0
+		self.buf += data
+		return True
+
+	def peek(self):
+		""" Next character that isn't white space, '' at the end """
+		while True:
+			buf = self.buf
+			pos = self.pos
+			while pos < len(buf) and buf[pos] in ' \t\r\n':
+				pos += 1
+			self.pos = pos
+			if pos < len(buf):
+				return buf[pos]
+			if not self.fill():
+				return ''
+
+	def expect(self, chars):
+		""" Read the next character, which must be one of chars """
+		c = self.peek()
+		if not c or c not in chars:
+			raise json.JSONDecodeError("Expecting one of %s" % chars,
+					self.buf, self.pos)
+		self.pos += 1
+		return c
+
+	def value(self):
+		""" Read the next value, reading more of the file until the whole
+		value is buffered """
+		self.peek()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buf, self.pos)
+			except json.JSONDecodeError:
+				# (at least) double what is buffered, so that a large
+				# value isn't decoded over and over
+				if self.fill(max(self.blocksize, len(self.buf) - self.pos)):
+					continue
+				raise
+			# a number may continue in the next block
+			if type(value) in (int, float) and \
+					not self.buf[end:].lstrip('0123456789.eE+-') and \
+					self.fill():
+				continue
+			self.pos = end
+			return value
+
+	def members(self):
+		""" Generates the keys of an object, the value of each has to be
+		read before the next """
+		self.expect('{')
+		if self.peek() == '}':
+			self.pos += 1
+			return
+		while True:
+			key = self.value()
+			if type(key) != str:
+				raise json.JSONDecodeError("Expecting a key", self.buf,
+						self.pos)
+			self.expect(':')
+			yield key
+			if self.expect(',}') == '}':
+				return
+
+	def items(self):
+		""" Generates the index of each item of an array, each has to be
+		read before the next """
+		self.expect('[')
+		if self.peek() == ']':
+			self.pos += 1
+			return
+		for ii in itertools.count():
+			yield ii
+			if self.expect(',]') == ']':
+				return
+
+###############################################################################
+# Tree Cache
+###############################################################################
+TREECACHE_VERSION = 2
+
+def tree_key(entfile):
+	""" Hash of everything the expanded tree of entfile depends on: the
+	script, where it is and the working directory (.PWD) """
+	h = hashlib.sha1()
+	h.update(repr((TREECACHE_VERSION, os.path.abspath(entfile),
+			os.getcwd())).encode())
+	with open(entfile, "rb") as f:
+		for block in iter(lambda: f.read(HASHBLOCK), b''):
+			h.update(block)
+	return h.hexdigest()
+
+def tree_file(cachedir, entfile):
+	""" Path of the compiled tree of entfile in cachedir """
+	name = hashlib.md5(os.path.abspath(entfile).encode()).hexdigest()
+	return os.path.join(cachedir, 'tree-%s.marshal' % name)
+
+def save_tree(filename, key, geners, variables, jobs, files):
+	""" Write an expanded tree to filename as marshal data: files are
+	numbered in the order of files and jobs refer to them by number:
+		(version, key, variables,
+		 [(inputs, outputs, cmds, runtime, limit) of geners],
+		 [path], [(gener, (input ids), (output ids), cmds)])
+	"""
+	ids = {path: ii for ii, path in enumerate(files)}
+	gids = {id(g): ii for ii, g in enumerate(geners)}
+	tree = (TREECACHE_VERSION, key, variables,
+			[(g.inputs, g.outputs, g.cmds, g.runtime, g.limit)
+				for g in geners],
+			list(files),
+			[(gids[id(j.parent)], tuple(ids[f.path] for f in j.inputs),
+				tuple(ids[f.path] for f in j.outputs), j.cmds) for j in jobs])
+
+	os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+	tmp = filename + '.tmp'
+	with open(tmp, "wb") as f:
+		marshal.dump(tree, f)
+	os.replace(tmp, filename)
+
+def load_tree(filename, key):
+	""" Read a tree written by save_tree, returns (geners, variables, jobs,
+	files) or None if there isn't one for key. The file is memory mapped
+	rather than read. """
+	try:
+		with open(filename, "rb") as f, \
+				mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+			tree = marshal.loads(mm)
+	except (OSError, ValueError, EOFError, TypeError):
+		return None
+	if type(tree) != type(()) or len(tree) != 6 or \
+			tree[0] != TREECACHE_VERSION or tree[1] != key:
+		return None
+	version, key, variables, gspecs, paths, jspecs = tree
+
+	geners = []
+	for inputs, outputs, cmds, runtime, limit in gspecs:
+		gen = Generator(inputs, outputs)
+		gen.cmds = cmds
+		gen.runtime = runtime
+		gen.limit = limit
+		geners.append(gen)
+
+	files = FileIndex()
+	for p in paths:
+		files.add(File(p, False))
+	flist = files.byid
+	jobs = [Job([flist[ii] for ii in ins], [flist[ii] for ii in outs], cmds,
+			geners[gg]) for gg, ins, outs, cmds in jspecs]
+	return geners, variables, jobs, files
+
+###############################################################################
+# Event Log
+###############################################################################
+class EventLog:
+	"""
+	Machine readable stream of job events, one JSON object per line:
+	{"time": ..., "event": "submitted", "outputs": [...], ...}. Without a
+	stream nothing is formatted.
+	"""
+
+	def __init__(self, stream = None):
+		self.stream = stream
+
+	def emit(self, event, job, **fields):
+		if self.stream is None:
+			return
+		fields['time'] = time.time()
+		fields['event'] = event
+		fields['outputs'] = [f.path for f in job.outputs]
+		self.stream.write(json.dumps(fields) + '\n')
+		self.stream.flush()
+
+###############################################################################
+# Control Socket
+###############################################################################
+class Control:
+	"""
+	Lets other processes watch and steer an Ent that is running (Ent.serve)
+	through a UNIX socket. Each request is a line of JSON,
+	{"command": NAME, ...}, answered with a line of JSON that has "ok" set
+	(and "error" if it is false). Commands:
+		status: numbers of jobs by status, how many finished in the last
+			minute and how many are queued (Ent.status)
+		pause: don't start new jobs, the jobs already running carry on
+		resume: start new jobs again
+		limit: {"value": N} run at most N jobs at once (null for no limit)
+		retry: run the jobs that failed, and those that didn't run because
+			they did, again
+		stop: pause and end the run once the running jobs are done
+	See control() for the other end.
+	"""
+
+	def __init__(self, ent, path):
+		self.ent = ent
+		self.path = path
+		self.server = None
+		self.stopping = False
+		self.changed = None # set when a request may let the run go on
+
+	async def start(self):
+		self.changed = asyncio.Event()
+		if os.path.exists(self.path):
+			try:
+				control(self.path, 'status')
+			except OSError:
+				os.remove(self.path) # left by a run that was killed
+			else:
+				raise InputError(self.path, "Error! Another ent is using %s"
+						% self.path)
+		self.server = await asyncio.start_unix_server(self.handle, self.path)
+		log.info("Listening for control requests on %s", self.path)
+
+	async def close(self):
+		self.server.close()
+		await self.server.wait_closed()
+		os.remove(self.path)
+
+	async def wait(self):
+		""" Wait for a request that may change what the run can do """
+		await self.changed.wait()
+		self.changed.clear()
+
+	async def handle(self, reader, writer):
+		try:
+			async for line in reader:
+				try:
+					reply = self.request(json.loads(line))
+				except (ValueError, TypeError, AttributeError) as e:
+					reply = {'ok' : False, 'error' : str(e)}
+				writer.write((json.dumps(reply) + '\n').encode())
+				await writer.drain()
+		except (ConnectionError, asyncio.CancelledError):
+			pass # client went away, or the run is over
+		finally:
+			writer.close()
+
+	def request(self, request):
+		""" Carry out a request, returns the reply """
+		ent = self.ent
+		command = request.get('command')
+		log.debug("Control request: %s", request)
+		reply = dict()
+		if command == 'status':
+			reply = ent.status()
+		elif command == 'pause':
+			ent.paused = True
+		elif command == 'resume':
+			ent.paused = False
+		elif command == 'limit':
+			value = request.get('value')
+			# bool is an int, but not a number of jobs
+			if value is not None and (type(value) != int or value < 1):
+				raise ValueError("limit must be a whole number >= 1, or "
+						"null, not %r" % (value,))
+			ent.maxrunning = value
+		elif command == 'retry':
+			reply['retried'] = ent.retry()
+		elif command == 'stop':
+			ent.paused = True
+			self.stopping = True
+		else:
+			return {'ok' : False, 'error' : "Unknown command %s" % command}
+
+		if command != 'status':
+			log.info("Control: %s", request)
+		self.changed.set()
+		reply['ok'] = True
+		return reply
+
+def control(path, command, value = None):
+	""" Send a request to the Control listening on path, returns the
+	reply """
+	request = {'command' : command}
+	if value is not None:
+		request['value'] = value
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+		sock.connect(path)
+		sock.sendall((json.dumps(request) + '\n').encode())
+		with sock.makefile("r") as f:
+			return json.loads(f.readline())
+
+###############################################################################
+# Metrics
+###############################################################################
+class Metrics:
+	"""
+	Timings and resource usage of every command run by Ent.run, one record
+	per command:
+		{'job': StateStore.jobkey, 'generator': Metrics.genkey, 'cmd': index
+		 of the command in the job, 'queued': time it was handed to the
+		 executor, 'submitted': time the executor accepted it, 'started',
+		 'finished', 'exitstatus', ...}
+	plus whatever resource usage the executor reports (Executor.resources).
+	Times are seconds since the epoch.
+	"""
+
+	def __init__(self):
+		self.records = []
+		self.jobtimes = dict() # Job -> seconds its commands ran for
+
+	@staticmethod
+	def genkey(gen):
+		""" Name of a Generator, its output patterns """
+		return " ".join(gen.outputs) if gen else ''
+
+	def add(self, job, record):
+		self.records.append(record)
+		self.jobtimes[job] = self.jobtimes.get(job, 0) + \
+				record['finished'] - record['started']
+
+	def summary(self):
+		""" Aggregates per Generator, {genkey: {'jobs', 'commands',
+		'failed', 'wall', 'maxwall', 'queue', 'cpu', 'maxrss'}}. wall and
+		queue (time between being queued and starting) are totals over
+		the commands, as is cpu (user + system time) where the executor
+		reports it """
+		out = dict()
+		jobs = collections.defaultdict(set)
+		for rec in self.records:
+			gen = out.setdefault(rec['generator'], {'jobs' : 0,
+				'commands' : 0, 'failed' : 0, 'wall' : 0, 'maxwall' : 0,
+				'queue' : 0, 'cpu' : 0, 'maxrss' : 0})
+			wall = rec['finished'] - rec['started']
+			jobs[rec['generator']].add(rec['job'])
+			gen['commands'] += 1
+			gen['failed'] += rec['exitstatus'] != 0
+			gen['wall'] += wall
+			gen['maxwall'] = max(gen['maxwall'], wall)
+			gen['queue'] += rec['started'] - rec['queued']
+			gen['cpu'] += rec.get('utime', 0) + rec.get('stime', 0)
+			gen['maxrss'] = max(gen['maxrss'], rec.get('maxrss', 0))
+		for key, gen in out.items():
+			gen['jobs'] = len(jobs[key])
+		return out
+
+	def report(self):
+		""" Log summary() at INFO, the Generators that took longest first """
+		summary = self.summary()
+		if not summary:
+			return
+		log.info("%8s %8s %7s %10s %10s %10s %10s  %s", "jobs", "commands",
+				"failed", "wall", "max wall", "queue", "cpu", "generator")
+		for key, gen in sorted(summary.items(), key = lambda kv:
+				-kv[1]['wall']):
+			log.info("%8i %8i %7i %10.1f %10.1f %10.1f %10.1f  %s",
+					gen['jobs'], gen['commands'], gen['failed'], gen['wall'],
+					gen['maxwall'], gen['queue'], gen['cpu'], key)
+
+	def trace(self, stream):
+		""" Write the records as Chrome trace events (chrome://tracing,
+		Perfetto): each command is a span from started to finished, after a
+		"queued" span from queued to started. Commands that overlap in time
+		are put on different rows. """
+		events = []
+		lanes = [] # heap of (time a row is free, row)
+		base = min((rec['queued'] for rec in self.records), default = 0)
+		for rec in sorted(self.records, key = lambda r: r['queued']):
+			if lanes and lanes[0][0] <= rec['queued']:
+				row = heapq.heappop(lanes)[1]
+			else:
+				row = len(lanes)
+			heapq.heappush(lanes, (rec['finished'], row))
+
+			args = {k: v for k, v in rec.items() if k not in ('queued',
+				'started', 'finished')}
+			if rec['started'] > rec['queued']:
+				events.append({'name' : 'queued', 'cat' : 'queue', 'ph' : 'X',
+					'pid' : 1, 'tid' : row,
+					'ts' : (rec['queued'] - base) * 1e6,
+					'dur' : (rec['started'] - rec['queued']) * 1e6,
+					'args' : args})
+			events.append({'name' : rec['job'], 'cat' : rec['generator'],
+				'ph' : 'X', 'pid' : 1, 'tid' : row,
+				'ts' : (rec['started'] - base) * 1e6,
+				'dur' : (rec['finished'] - rec['started']) * 1e6,
+				'args' : args})
+		json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, stream)
+
+###############################################################################
+# Executors
+###############################################################################
+class Executor:
+	"""
+	Interface between Ent.run and whatever actually runs commands. A command
+	is a list of arguments, the first being the program to run. Commands of a
+	single Job are submitted one at a time, in order, by Ent.run.
+	"""
+
+	njobs = None # commands it runs at once, None if it has no limit
+
+	def start(self):
+		""" Acquire resources (sessions, pools) before the first submit """
+		pass
+
+	def submit(self, cmd):
+		""" Start cmd, returns a handle that wait() will report """
+		raise NotImplementedError
+
+	def submitBulk(self, cmds):
+		""" Start several commands (usually the same command of jobs from one
+		Generator), returns a handle for each """
+		return [self.submit(cmd) for cmd in cmds]
+
+	def wait(self, timeout = None):
+		""" Block until a submitted command finishes, for up to timeout
+		seconds (forever if None), returns (handle, exitstatus) or None if
+		none did """
+		raise NotImplementedError
+
+	def harvest(self, timeout = None):
+		""" Waits up to timeout seconds (forever if None) for a submitted
+		command to finish, then returns [(handle, exitstatus), ...] for every
+		command that has finished """
+		out = []
+		done = self.wait(timeout)
+		while done is not None:
+			out.append(done)
+			done = self.wait(0)
+		return out
+
+	def resources(self, handle):
+		""" Timings and resource usage of a finished command, as far as the
+		executor knows them: {'started': time, 'finished': time, 'utime':
+		user seconds, 'stime': system seconds, 'maxrss': kilobytes, ...}.
+		Forgotten once returned. """
+		return {}
+
+	async def harvest_async(self, timeout = None):
+		""" harvest() for asyncio. By default harvest() is polled from a
+		worker thread, POLLTIME seconds at a time, so that the event loop is
+		never blocked for long """
+		while True:
+			if timeout is None:
+				step = POLLTIME
+			else:
+				step = min(timeout, POLLTIME)
+			done = await asyncio.to_thread(self.harvest, step)
+			if done or timeout is not None:
+				return done
+
+	def stop(self):
+		""" Release resources acquired in start() """
+		pass
+
+class LocalExecutor(Executor):
+	"""
+	Runs commands as subprocesses of this machine, at most njobs at once.
+	Finished commands are queued by the pool threads, so harvesting costs
+	nothing for the commands that are still running.
+	"""
+
+	def __init__(self, njobs = None):
+		self.njobs = njobs or os.cpu_count() or 1
+		self.pool = None
+		self.count = 0
+		self.done = collections.deque() # (handle, exitstatus) not harvested
+		self.usage = dict() # handle -> resources() of finished commands
+		self.cond = threading.Condition()
+		self.waker = None # wakes harvest_async from a pool thread
+
+	def start(self):
+		self.pool = concurrent.futures.ThreadPoolExecutor(self.njobs)
+
+	def submit(self, cmd):
+		self.count += 1
+		handle = self.count
+		fut = self.pool.submit(self.call, cmd)
+		fut.add_done_callback(lambda f: self.finished(handle,
+				*self.outcome(f, cmd)))
+		return handle
+
+	@staticmethod
+	def outcome(fut, cmd):
+		""" (exitstatus, resources) of the finished future of call(), a
+		failure if it raised, so that the command is still reported """
+		try:
+			return fut.result()
+		except BaseException as e:
+			log.error("Error running %s: %r", cmd, e)
+			return 127, {}
+
+	@staticmethod
+	def call(cmd):
+		""" Runs cmd, returns (exitstatus, resources) """
+		usage = {'started' : time.time()}
+		try:
+			proc = subprocess.Popen(cmd)
+		except (OSError, ValueError, TypeError) as e:
+			log.error("Error running %s: %s", cmd, e)
+			return 127, usage
+
+		pid, status, ru = os.wait4(proc.pid, 0)
+		proc.returncode = os.waitstatus_to_exitcode(status)
+		usage.update(finished = time.time(), utime = ru.ru_utime,
+				stime = ru.ru_stime, maxrss = ru.ru_maxrss)
+		return proc.returncode, usage
+
+	def finished(self, handle, exitstatus, usage):
+		with self.cond:
+			self.done.append((handle, exitstatus))
+			self.usage[handle] = usage
+			self.cond.notify_all()
+			if self.waker:
+				self.waker()
+
+	def wait(self, timeout = None):
+		with self.cond:
+			if not self.cond.wait_for(lambda: self.done, timeout):
+				return None
+			return self.done.popleft()
+
+	def harvest(self, timeout = None):
+		with self.cond:
+			self.cond.wait_for(lambda: self.done, timeout)
+			out = list(self.done)
+			self.done.clear()
+		return out
+
+	async def harvest_async(self, timeout = None):
+		loop = asyncio.get_running_loop()
+		event = asyncio.Event()
+		with self.cond:
+			out = None
+			if self.done or timeout == 0:
+				out = list(self.done)
+				self.done.clear()
+			else:
+				self.waker = lambda: loop.call_soon_threadsafe(event.set)
+		if out is not None:
+			# let the rest of the event loop run, even if nothing waits
+			await asyncio.sleep(0)
+			return out
+
+		try:
+			await asyncio.wait_for(event.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+		finally:
+			with self.cond:
+				self.waker = None
+		return self.harvest(0)
+
+	def resources(self, handle):
+		with self.cond:
+			return self.usage.pop(handle, {})
+
+	def stop(self):
+		self.pool.shutdown()
+		self.pool = None
+
+class DrmaaExecutor(Executor):
+	"""
+	Submits every command as a grid engine job through DRMAA. Commands
+	submitted together are submitted as one array (bulk) job: the commands
+	are written to a task file in workdir and each task runs
+	ent.py --run-task on it, which picks its command by the task index.
+	"""
+
+	def __init__(self, workdir = None, bulk = True):
+		self.workdir = workdir or WORKDIR
+		self.bulk = bulk
+		self.session = None
+		self.template = None
+		self.tasks = dict() # handle -> task file of array jobs
+		self.ntasks = dict() # task file -> number of unfinished tasks
+		self.usage = dict() # handle -> resources() of finished jobs
+
+	def start(self):
+		initdrmaa()
+		self.session = drmaa.Session()
+		self.session.initialize()
+		self.template = self.session.createJobTemplate()
+
+	def submit(self, cmd):
+		self.template.remoteCommand = cmd[0]
+		self.template.args = cmd[1:]
+		return self.session.runJob(self.template)
+
+	def submitBulk(self, cmds):
+		if not self.bulk or len(cmds) < 2:
+			return Executor.submitBulk(self, cmds)
+
+		os.makedirs(self.workdir, exist_ok=True)
+		fd, taskfile = tempfile.mkstemp(prefix='tasks-', suffix='.json',
+				dir=self.workdir)
+		with os.fdopen(fd, "w") as f:
+			for cmd in cmds:
+				f.write(json.dumps(cmd) + '\n')
+
+		self.template.remoteCommand = sys.executable
+		self.template.args = [os.path.abspath(__file__), '--run-task',
+				os.path.abspath(taskfile)]
+		pids = self.session.runBulkJobs(self.template, 1, len(cmds), 1)
+		for pid in pids:
+			self.tasks[pid] = taskfile
+		self.ntasks[taskfile] = len(pids)
+		return pids
+
+	def wait(self, timeout = None):
+		if timeout is None:
+			timeout = drmaa.Session.TIMEOUT_WAIT_FOREVER
+		try:
+			jobinfo = self.session.wait(drmaa.Session.JOB_IDS_SESSION_ANY,
+					timeout)
+		except drmaa.ExitTimeoutException:
+			return None
+		self.taskDone(jobinfo)
+		return jobinfo.jobId, jobinfo.exitStatus
+
+	def harvest(self, timeout = None):
+		if timeout is None:
+			timeout = drmaa.Session.TIMEOUT_WAIT_FOREVER
+		out = []
+		try:
+			while True:
+				jobinfo = self.session.wait(drmaa.Session.JOB_IDS_SESSION_ANY,
+						timeout)
+				self.taskDone(jobinfo)
+				out.append((jobinfo.jobId, jobinfo.exitStatus))
+				timeout = drmaa.Session.TIMEOUT_NO_WAIT
+		except drmaa.ExitTimeoutException:
+			pass
+		return out
+
+	def taskDone(self, jobinfo):
+		""" Keeps the resource usage of a finished job, removes the task file
+		of an array job once all tasks are done """
+		pid = jobinfo.jobId
+		self.usage[pid] = self.convertUsage(getattr(jobinfo,
+				'resourceUsage', None) or {})
+		taskfile = self.tasks.pop(pid, None)
+		if taskfile is None:
+			return
+		self.ntasks[taskfile] -= 1
+		if self.ntasks[taskfile] == 0:
+			del(self.ntasks[taskfile])
+			try:
+				os.remove(taskfile)
+			except OSError as e:
+				pass
+
+	# resourceUsage names (Grid Engine) of the keys of resources()
+	USAGE_NAMES = {'start_time' : 'started', 'end_time' : 'finished',
+			'ru_utime' : 'utime', 'ru_stime' : 'stime', 'ru_maxrss' : 'maxrss'}
+
+	@classmethod
+	def convertUsage(cls, usage):
+		""" resources() from DRMAA resourceUsage, whose values are strings.
+		Numbers are converted, times in milliseconds to seconds. """
+		out = dict()
+		for name, value in usage.items():
+			try:
+				value = float(value)
+			except (TypeError, ValueError):
+				pass
+			name = cls.USAGE_NAMES.get(name, name)
+			if name in ('started', 'finished'):
+				if type(value) != float or not value:
+					continue
+				if value > 1e11:
+					value /= 1000
+			out[name] = value
+		return out
+
+	def resources(self, handle):
+		return self.usage.pop(handle, {})
+
+	def stop(self):
+		self.session.deleteJobTemplate(self.template)
+		self.session.exit()
+		self.session = None
+
+class TreeExecutor(Executor):
+	"""
+	The executor of a Master as seen by one of its trees: submissions go to
+	the Master's executor and are remembered as the tree's, so that the
+	Master can hand each finished command to the tree that submitted it.
+	The Master starts, stops and harvests the executor.
+	"""
+
+	def __init__(self, master, ent):
+		self.master = master
+		self.ent = ent
+
+	def submit(self, cmd):
+		return self.submitBulk([cmd])[0]
+
+	def submitBulk(self, cmds):
+		pids = self.master.executor.submitBulk(cmds)
+		for pid in pids:
+			self.master.owners[pid] = self.ent
+		return pids
+
+	def resources(self, handle):
+		return self.master.executor.resources(handle)
+
+EXECUTORS = {'local' : LocalExecutor, 'drmaa' : DrmaaExecutor}
+
+###############################################################################
+# State Stores
+###############################################################################
+SQLITE_MAGIC = b'SQLite format 3\0'
+
+def openState(filename, readonly = False):
+	""" Opens the state file filename. Files ending in .json are kept in the
+	original JSON format, anything else is stored in SQLite. An existing JSON
+	state file with another name is converted to SQLite in place, unless
+	readonly is set (nothing is created or converted then, the store is
+	only read). A file that is neither is an InputError. """
+	if filename.endswith('.json'):
+		return JsonStateStore(filename)
+
+	try:
+		with open(filename, "rb") as f:
+			magic = f.read(len(SQLITE_MAGIC))
+	except OSError:
+		magic = None
+	if readonly and not magic:
+		# nothing to read, JsonStateStore.load() of it is empty
+		return JsonStateStore(filename)
+	if magic is None or magic == SQLITE_MAGIC or not magic:
+		return SqliteStateStore(filename, readonly)
+
+	try:
+		with open(filename, "r") as f:
+			sums = json.load(f)
+	except (OSError, ValueError):
+		sums = None
+	if type(sums) != dict:
+		raise InputError(filename, "Error! %s is neither an SQLite nor a "
+				"JSON state file" % filename)
+	if readonly:
+		return JsonStateStore(filename)
+
+	log.info("Converting %s to SQLite", filename)
+	tmp = filename + '.tmp'
+	if os.path.exists(tmp):
+		os.remove(tmp)
+	store = SqliteStateStore(tmp)
+	store.save(sums)
+	store.close()
+	os.replace(tmp, filename)
+	store = SqliteStateStore(filename)
+	store.converted = True
+	return store
+
+class StateStore:
+	"""
+	Record of the fingerprint of every file when it was last known to be up
+	to date, {path: fingerprint}. A job whose outputs all match is not rerun.
+	Stores are told when jobs start and finish so that the record stays
+	correct if ent is killed part way through a run: started() forgets the
+	fingerprints of the outputs, finished() stores them again. Stores may
+	also keep the signature (Job.signature) each job last succeeded with.
+	"""
+
+	signed = False    # whether signatures are kept (see Ent.upToDate)
+	converted = False # converted by openState() during this run
+
+	@staticmethod
+	def jobkey(job):
+		""" Name of job in the store, its first output """
+		if job.outputs:
+			return job.outputs[0].path
+		return job.cmds[0] if job.cmds else ''
+
+	def load(self):
+		""" Returns {path: fingerprint} """
+		raise NotImplementedError
+
+	def signatures(self):
+		""" Returns {jobkey: signature} """
+		return dict()
+
+	def runtimes(self):
+		""" Returns {jobkey: seconds the job took the last time it
+		succeeded} """
+		return dict()
+
+	def adopt(self, signatures):
+		""" Keep {jobkey: signature} of jobs that are up to date but had no
+		signature """
+		pass
+
+	def started(self, jobs):
+		""" jobs are about to be run """
+		pass
+
+	def finished(self, job, sums, signature = None, runtime = None):
+		""" job succeeded in runtime seconds, its outputs now have
+		fingerprints sums """
+		pass
+
+	def failed(self, job):
+		""" job failed """
+		pass
+
+	def commands(self, records):
+		""" Keep the Metrics records of the commands of a run """
+		pass
+
+	def save(self, sums):
+		""" Replace the whole record with sums """
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+class JsonStateStore(StateStore):
+	"""
+	The original state file, a JSON dict {path: fingerprint}. Only written
+	by save(), so completions since the last save are lost if ent is killed.
+	Signatures aren't kept, so jobs are only checked by their outputs.
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+
+	def load(self):
+		try:
+			with open(self.filename, "r") as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return dict()
+
+	def save(self, sums):
+		tmp = self.filename + '.tmp'
+		with open(tmp, "w") as f:
+			json.dump(sums, f, indent=1)
+		os.replace(tmp, self.filename)
+
+class SqliteStateStore(StateStore):
+	"""
+	State in an SQLite database in WAL mode. Every start and completion is
+	committed as it happens, so after a crash only the jobs that were running
+	are rerun. Also records the last outcome of each job, and the signature
+	and runtime of its last success, keyed by its first output, and the
+	Metrics of every command run. A readonly store is opened as it is, to be
+	read.
+	"""
+
+	signed = True
+
+	def __init__(self, filename, readonly = False):
+		self.filename = filename
+		self.db = sqlite3.connect(filename, check_same_thread = False)
+		self.lock = threading.Lock()
+		self.readonly = readonly
+		if readonly:
+			return
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		with self.db:
+			self.db.execute('CREATE TABLE IF NOT EXISTS files '
+					'(path TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)')
+			self.db.execute('CREATE TABLE IF NOT EXISTS jobs '
+					'(key TEXT PRIMARY KEY, status TEXT NOT NULL, '
+					'time REAL NOT NULL, signature TEXT, runtime REAL)')
+			self.db.execute('CREATE TABLE IF NOT EXISTS commands '
+					'(job TEXT NOT NULL, generator TEXT NOT NULL, '
+					'cmd INTEGER NOT NULL, queued REAL NOT NULL, '
+					'submitted REAL NOT NULL, started REAL NOT NULL, '
+					'finished REAL NOT NULL, exitstatus INTEGER, '
+					'usage TEXT)')
+
+	def setStatus(self, jobs, status, signature = None, runtime = None):
+		""" The runtime of the last success is kept until there is a new
+		one """
+		now = time.time()
+		self.db.executemany('INSERT INTO jobs VALUES (?, ?, ?, ?, ?) '
+				'ON CONFLICT(key) DO UPDATE SET status = excluded.status, '
+				'time = excluded.time, signature = excluded.signature, '
+				'runtime = COALESCE(excluded.runtime, runtime)',
+				[(self.jobkey(job), status, now, signature, runtime)
+					for job in jobs])
+
+	def load(self):
+		with self.lock:
+			return dict(self.db.execute(
+				'SELECT path, fingerprint FROM files'))
+
+	def signatures(self):
+		with self.lock:
+			return dict(self.db.execute('SELECT key, signature FROM jobs '
+				'WHERE signature IS NOT NULL'))
+
+	def runtimes(self):
+		with self.lock:
+			return dict(self.db.execute('SELECT key, runtime FROM jobs '
+				'WHERE runtime IS NOT NULL'))
+
+	def adopt(self, signatures):
+		if self.readonly:
+			return
+		now = time.time()
+		with self.lock, self.db:
+			self.db.executemany('INSERT INTO jobs VALUES '
+					'(?, \'SUCCESS\', ?, ?, NULL) ON CONFLICT(key) DO UPDATE '
+					'SET signature = excluded.signature',
+					[(key, now, sig) for key, sig in signatures.items()])
+
+	def started(self, jobs):
+		with self.lock, self.db:
+			self.db.executemany('DELETE FROM files WHERE path = ?',
+					[(f.path,) for job in jobs for f in job.outputs])
+			self.setStatus(jobs, 'RUNNING')
+
+	def finished(self, job, sums, signature = None, runtime = None):
+		with self.lock, self.db:
+			self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?)',
+					sums.items())
+			self.setStatus([job], 'SUCCESS', signature, runtime)
+
+	def failed(self, job):
+		with self.lock, self.db:
+			self.setStatus([job], 'FAIL')
+
+	COMMAND_COLUMNS = ('job', 'generator', 'cmd', 'queued', 'submitted',
+			'started', 'finished', 'exitstatus')
+
+	def commands(self, records):
+		""" Columns of the commands table, the rest of the record (resource
+		usage) as JSON in usage """
+		rows = []
+		for rec in records:
+			usage = {k: v for k, v in rec.items()
+					if k not in self.COMMAND_COLUMNS}
+			rows.append([rec[k] for k in self.COMMAND_COLUMNS] +
+					[json.dumps(usage)])
+		with self.lock, self.db:
+			self.db.executemany('INSERT INTO commands VALUES '
+					'(?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+	def save(self, sums):
+		with self.lock, self.db:
+			self.db.execute('DELETE FROM files')
+			self.db.executemany('INSERT INTO files VALUES (?, ?)',
+					sums.items())
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+###############################################################################
+# Fingerprint Cache
+###############################################################################
+class FingerprintCache:
+	"""
+	Persistent record of content hashes, so that large files are only read
+	again when their (inode, size, mtime) changes. Stored as JSON:
+	{path: [inode, size, mtime_ns, mode, fingerprint]}
+	"""
+
+	def __init__(self, filename = None):
+		self.filename = filename
+		self.entries = dict()
+		self.hits = 0
+		self.misses = 0
+		self.dirty = False
+		self.lock = threading.Lock() # lookups come from scan_files threads
+		# {path: fingerprint} of the files already scanned while several
+		# trees load (see Master), so that files they share are only looked
+		# at once. None when not in use, files change once jobs run.
+		self.known = None
+		if filename:
+			try:
+				with open(filename, "r") as f:
+					self.entries = json.load(f)
+			except (IOError, ValueError):
+				pass
+
+	def lookup(self, path, stat, mode):
+		""" Cached fingerprint of path, or None if the stat doesn't match """
+		ent = self.entries.get(path)
+		if ent and ent[:4] == [stat.st_ino, stat.st_size, stat.st_mtime_ns,
+				mode]:
+			with self.lock:
+				self.hits += 1
+			return ent[4]
+		with self.lock:
+			self.misses += 1
+		return None
+
+	def store(self, path, stat, mode, fp):
+		self.entries[path] = [stat.st_ino, stat.st_size, stat.st_mtime_ns,
+				mode, fp]
+		self.dirty = True
+
+	def save(self):
+		if not self.filename or not self.dirty:
+			return
+		tmp = self.filename + '.tmp'
+		with open(tmp, "w") as f:
+			json.dump(self.entries, f)
+		os.replace(tmp, self.filename)
+		self.dirty = False
+
+###############################################################################
+# Scheduler Class
+###############################################################################
+class Scheduler:
+	"""
+	Tracks, for every job, the number of upstream jobs (File.genr of its
+	inputs) that have not finished yet. When a job finishes only the users of
+	its outputs (File.users) are touched, so the cost of a completion is
+	proportional to the fan-out of the job rather than to the number of jobs.
+	Jobs whose dependencies are all met are placed on the ready queue, a heap
+	that pop() takes the job with the highest Job.priority from (the first
+	one added, of equal priorities).
+
+	If the scheduler is created without a list of jobs, it is open: jobs may
+	be added while others run, and an input without a generator may still be
+	claimed by a job that hasn't been added yet. Such inputs count as
+	unfinished until a job producing them is added or close() is called,
+	or, if given, producible() says no job added later can make them (see
+	recheck).
+
+	A job added later may also make the inputs of a job that succeeded,
+	which then has to be made again (see invalidate). With hold set, jobs
+	that succeeded only count as finished for the jobs using their outputs
+	once settle() says that can't happen any more (or they are DONE), so
+	that nothing is started, and made twice, before its inputs are final.
+	"""
+
+	def __init__(self, jobs = None):
+		self.ready = [] # heap of (-priority, n, job), jobs with all inputs
+		self.count = itertools.count() # produced, n keeps the order stable
+		self.orphans = dict() # File without generator -> jobs waiting on it
+		self.producible = None # File -> whether a job added later may make it
+		self.hold = False # SUCCESS jobs only count as finished once settled
+		self.unfinished = 0 # jobs being tracked that haven't finished
+		self.closed = jobs is not None
+		if jobs:
+			for job in jobs:
+				self.add(job)
+
+	def add(self, job):
+		""" Start tracking a job. Jobs that are already SUCCESS are left
+		alone, jobs with failed upstream jobs become DEPFAIL, the rest are
+		either queued as ready or wait on their producers. """
+		if self.orphans:
+			self.claim(job)
+
+		if job.status == 'SUCCESS':
+			return
+
+		job.status = 'WAITING'
+		job.nwait = 0
+		self.unfinished += 1
+		self.invalidate(job)
+		for dep in self.producers(job):
+			if dep.status == 'FAIL' or dep.status == 'DEPFAIL':
+				self.depfail(job)
+				return
+			elif dep.status != 'SUCCESS' or self.hold and dep is not DONE:
+				job.nwait += 1
+
+		if not self.closed:
+			for f in dict.fromkeys(job.inputs):
+				if f.genr is None and (self.producible is None or
+						self.producible(f)):
+					self.orphans.setdefault(f, []).append(job)
+					job.nwait += 1
+
+		if job.nwait == 0:
+			self.push(job)
+
+	def push(self, job):
+		""" Add job to the ready queue """
+		heapq.heappush(self.ready, (-job.priority, next(self.count), job))
+
+	def pop(self):
+		""" Take the ready job with the highest priority, None if the ready
+		queue only held jobs that have to wait again (see invalidate) """
+		while self.ready:
+			job = heapq.heappop(self.ready)[2]
+			if job.status == 'WAITING' and job.nwait == 0:
+				return job
+		return None
+
+	def invalidate(self, job):
+		""" job is going to be (re)made. Jobs using its outputs may have
+		been added, as SUCCESS, before it was: they and the SUCCESS jobs
+		downstream of them are tracked again, and the waiting jobs using
+		their outputs wait for them again. Jobs that are running can't use
+		the outputs of a SUCCESS job that may still be remade (see hold),
+		nor of one added after they started. """
+		again = dict()
+		stack = [job]
+		while stack:
+			for user in self.consumers(stack.pop()):
+				if user.status == 'SUCCESS' and user not in again:
+					again[user] = None
+					stack.append(user)
+		if not again:
+			return
+
+		log.debug("Remaking %i jobs downstream of: %s", len(again), job)
+		for user in again:
+			user.status = 'RETRY'
+		for user in again:
+			# with hold, waiting jobs already wait on SUCCESS jobs that
+			# aren't DONE, jobs in again count each other when added
+			if not self.hold:
+				for after in self.consumers(user):
+					if after.status == 'WAITING' and after not in again:
+						after.nwait += 1
+			self.add(user)
+
+	def claim(self, job):
+		""" Jobs waiting on outputs of job, which had no generator when they
+		were added, now wait on job (once, however many of its outputs they
+		use) """
+		counts = collections.Counter()
+		for f in job.outputs:
+			for user in self.orphans.pop(f, ()):
+				counts[user] += 1
+
+		for user, count in counts.items():
+			if user.status != 'WAITING':
+				continue
+			if job.status == 'SUCCESS' and not self.hold:
+				self.release(user, count)
+			else:
+				user.nwait -= count - 1
+
+	def close(self):
+		""" No more jobs will be added, inputs that no job produces are
+		files that already exist """
+		self.closed = True
+		for f, users in self.orphans.items():
+			for user in users:
+				if user.status == 'WAITING':
+					self.release(user, 1)
+		self.orphans = dict()
+
+	def recheck(self):
+		""" Inputs that producible() no longer expects a job to make are
+		files that already exist """
+		for f in [f for f in self.orphans if not self.producible(f)]:
+			for user in self.orphans.pop(f):
+				if user.status == 'WAITING':
+					self.release(user, 1)
+
+	def release(self, job, count):
+		""" count of the things job waits on are done """
+		job.nwait -= count
+		if job.nwait == 0:
+			self.push(job)
+
+	def finish(self, job, success):
+		""" Mark job as finished (SUCCESS or FAIL) and release (unless
+		hold is set, see settle) or fail the jobs that use its outputs """
+		self.unfinished -= 1
+		if not success:
+			job.status = 'FAIL'
+			for user in self.consumers(job):
+				self.depfail(user)
+			return
+
+		job.status = 'SUCCESS'
+		if not self.hold:
+			self.settle(job)
+
+	def settle(self, job):
+		""" Release the jobs using the outputs of job, which succeeded and
+		won't be made again """
+		for user in self.consumers(job):
+			if user.status == 'WAITING':
+				self.release(user, 1)
+
+	def retry(self, jobs):
+		""" Track failed (FAIL and DEPFAIL) jobs again, as if they had just
+		been added. Failed jobs upstream of any of jobs must be in jobs
+		too. """
+		for job in jobs:
+			job.status = 'RETRY'
+		for job in jobs:
+			self.add(job)
+
+	def depfail(self, job):
+		""" Mark job and every waiting job downstream of it as DEPFAIL """
+		stack = [job]
+		while stack:
+			job = stack.pop()
+			if job.status != 'WAITING':
+				continue
+			job.status = 'DEPFAIL'
+			self.unfinished -= 1
+			log.info("Dependency Failed for:%s", job)
+			stack.extend(self.consumers(job))
+
+	@staticmethod
+	def producers(job):
+		""" Unique jobs that generate the inputs of job """
+		return dict.fromkeys(f.genr for f in job.inputs if f.genr)
+
+	@staticmethod
+	def consumers(job):
+		""" Unique jobs that use the outputs of job """
+		return dict.fromkeys(u for f in job.outputs for u in f.users)
+
+###############################################################################
+# FileIndex Class
+###############################################################################
+class FileIndex:
+	"""
+	All Files of a tree, by path. Behaves as a dict {path: File} (paths
+	must be normalized, see normpath) and also:
+		- numbers Files in the order they were added (File.fid, byid)
+		- groups them by directory, so that the Files under a directory, or
+		  the Files of each directory (bydir), are found without looking at
+		  every path
+
+	Whole paths aren't kept: a File holds the name of its directory and its
+	own name (see File.path), both interned so that the Files in a
+	directory share one string for it, as do Files of the same name in
+	different directories. Roots are '/', '//' (see normpath) and '' (the
+	directory of relative paths).
+	"""
+
+	def __init__(self):
+		self.byid = []        # fid -> File
+		self.dirs = dict()    # directory -> {name: File}
+		self.subdirs = dict() # directory -> [directories in it]
+
+	def add(self, f):
+		""" Add File f, which must not be in the index yet """
+		f.fid = len(self.byid)
+		self.byid.append(f)
+		f.dir = sys.intern(f.dir)
+		f.name = sys.intern(f.name)
+		names = self.dirs.get(f.dir)
+		if names is None:
+			names = self.dirs[f.dir] = dict()
+			self.link(f.dir)
+		names[f.name] = f
+
+	def link(self, dname):
+		""" Record directory dname in subdirs, and the directories it is in
+		up to its root """
+		child = None
+		while True:
+			known = dname in self.subdirs
+			subdirs = self.subdirs.setdefault(dname, [])
+			if child is not None:
+				subdirs.append(child)
+			if known:
+				return
+			parent, name = split_path(dname)
+			if not name:
+				return
+			child, dname = dname, parent
+
+	def lookup(self, name):
+		""" File for path name (which needn't be normalized), created if
+		there isn't one """
+		path = normpath(name)
+		f = self.get(path)
+		if f is None:
+			f = File(path, False)
+			self.add(f)
+		return f
+
+	def under(self, directory):
+		""" Generates the Files at or under directory """
+		path = normpath(directory)
+		if path == '.':
+			path = ''
+		else:
+			f = self.get(path)
+			if f is not None and f.name:
+				yield f
+
+		stack = [path]
+		while stack:
+			dname = stack.pop()
+			names = self.dirs.get(dname)
+			if names:
+				yield from names.values()
+			stack.extend(self.subdirs.get(dname, ()))
+
+	def bydir(self, files = None):
+		""" {directory: {name: path}} of the Files (all of them, or those in
+		the set files), as scan_files() groups paths """
+		out = dict()
+		for dname, names in self.dirs.items():
+			prefix = dname if not dname or dname[-1] == '/' else dname + '/'
+			paths = {name: prefix + name if name else dname
+					for name, f in names.items()
+					if files is None or f in files}
+			if paths:
+				out[dname] = paths
+		return out
+
+	# dict interface, by path
+	def __setitem__(self, path, f):
+		if path != f.path:
+			raise InputError(path, "File index path doesn't match %s" %
+					f.path)
+		self.add(f)
+
+	def __getitem__(self, path):
+		f = self.get(path)
+		if f is None:
+			raise KeyError(path)
+		return f
+
+	def get(self, path, default = None):
+		dname, name = split_path(path)
+		names = self.dirs.get(dname)
+		if names is None:
+			return default
+		return names.get(name, default)
+
+	def __contains__(self, path):
+		return self.get(path) is not None
+
+	def __iter__(self):
+		return (f.path for f in self.byid)
+
+	def __len__(self):
+		return len(self.byid)
+
+	def keys(self):
+		return iter(self)
+
+	def values(self):
+		return iter(self.byid)
+
+	def items(self):
+		return ((f.path, f) for f in self.byid)
 
 ###############################################################################
 # File Class
@@ -779,14 +3493,19 @@ class File:
 	in an md5 check, which returns success if it matches the previous value
 	"""
 
-	path = None  # final path to use for input/output
-	force = ""      # force update of file even if file exists with the same md5
-	md5sum = 0      # md5sum
-	genr = None     # pointer to the Job which generates the file
-	users = []      # List of Downstream Jobs that need this file
-	finished = False
-
-	def __init__(self, path):
+	# There are millions of Files in a large tree, so no per instance dict
+	__slots__ = (
+		'dir',      # directory of the path (see path)
+		'name',     # last component of the path, '' for a root
+		'force',    # force update of file even if file exists with the same md5
+		'md5sum',   # md5sum
+		'genr',     # pointer to the Job which generates the file
+		'users',    # Downstream Jobs that need this file, () until there is one
+		'finished',
+		'fid',      # number in the FileIndex, None if not in one
+	)
+
+	def __init__(self, path, normalize = True):
 		""" Constructor for File class.
 
 		Parameters
@@ -794,16 +3513,32 @@ class File:
 		path : string
 			the input/output file path that may be on the local machine or on
 			any remote server
+		normalize : bool
+			clean up path (remove duplicate /'s etc.), False if it already
+			has been
 		"""
 
-		self.path = str(Path(path))
+		self.dir, self.name = split_path(normpath(path) if normalize
+				else path)
+		self.fid = None
 		self.finished = False
+		self.force = ""
 
 		# Should be Updated By Job
 		self.genr = None
-		self.users = []
+		self.users = ()
 		self.md5sum = None
 
+	@property
+	def path(self):
+		""" final path to use for input/output """
+		dname = self.dir
+		if not self.name:
+			return dname
+		elif not dname or dname[-1] == '/':
+			return dname + self.name
+		return dname + '/' + self.name
+
 	# does whatever is necessary to produce this file
 	def produce(self):
 		if self.finished:
@@ -820,6 +3555,85 @@ class File:
 			return str(self.path) + " (incomplete) "
 
 
+###############################################################################
+# CommandTemplate Class
+###############################################################################
+class CommandTemplate:
+	"""
+	A command split into pieces once, so that producing the command of a Job
+	is a single pass over the pieces. Pieces are (kind, value):
+		LITERAL  - text
+		VARIABLE - ${VAR}, the value of a variable (which may contain more
+		           references, rendered in turn)
+		ALLIN    - $< or ${<}, all inputs
+		ALLOUT   - $> or ${>}, all outputs
+		INPUT    - ${<N}, the N'th input
+		OUTPUT   - ${>N}, the N'th output
+	"""
+
+	LITERAL, VARIABLE, ALLIN, ALLOUT, INPUT, OUTPUT = range(6)
+
+	def __init__(self, string):
+		self.string = string
+		self.pieces = compile_template(string)
+
+	def render(self, inputs, outputs, localvars = None, gvars = None):
+		""" Returns the command for the given input and output paths.
+		Variables are looked up in localvars, then in gvars (which must have
+		a single value). If neither is given variables are left as is.
+		"""
+		out = []
+		self._render(self.pieces, inputs, outputs, localvars, gvars, out, 0)
+		return "".join(out)
+
+	def _render(self, pieces, inputs, outputs, localvars, gvars, out, depth):
+		if depth > MAXDEPTH:
+			raise InputError(self.string, "Circular Variable References "
+					"Detected!")
+
+		for kind, value in pieces:
+			if kind == self.LITERAL:
+				out.append(value)
+			elif kind == self.VARIABLE:
+				if localvars is None and gvars is None:
+					out.append("${%s}" % value)
+					continue
+				elif localvars and value in localvars:
+					# variable in the list of output vars, just sub in
+					val = localvars[value]
+				elif gvars and value in gvars and \
+						type(gvars[value]) != type(()):
+					# if it is a global variable, then we don't have a
+					# value from output, if there are multiple values
+					# then it is a compound (multivalue) input
+					val = gvars[value]
+					if len(val) != 1:
+						raise InputError(self.string, "Error cannot place "
+								"multi-value variable %s in a command" % value)
+					val = val[0]
+				else:
+					raise InputError(self.string, 'Error, command references '
+							'variable "%s" which is unknown!' % value)
+				self._render(compile_template(val), inputs, outputs, localvars,
+						gvars, out, depth+1)
+			elif kind == self.ALLIN:
+				out.append(" ".join(inputs))
+			elif kind == self.ALLOUT:
+				out.append(" ".join(outputs))
+			elif kind == self.INPUT:
+				if value >= len(inputs):
+					raise InputError("expand", "Error Resolving input number "
+							"%i in\n%s" % (value, self.string))
+				out.append(inputs[value])
+			else:
+				if value >= len(outputs):
+					raise InputError("expand", "Error Resolving Output number "
+							"%i in\n%s" % (value, self.string))
+				out.append(outputs[value])
+
+	def __str__(self):
+		return self.string
+
 ###############################################################################
 # Generator Class
 ###############################################################################
@@ -837,6 +3651,35 @@ class Generator:
 		self.cmds = list()
 		self.inputs = copy.deepcopy(inputs)
 		self.outputs = copy.deepcopy(outputs)
+		self.runtime = None # estimated seconds per job
+		self.limit = None   # maximum number of jobs running at once
+		self.tails = None   # see mayMake
+
+	def mayMake(self, path):
+		""" Whether one of the jobs of this Generator could have path
+		(normalized) as an output, without expanding them. Outputs without
+		variables have to match, otherwise the last component of the text
+		after the last variable has to end path. """
+		if self.tails is None:
+			self.tails = []
+			for out in self.outputs:
+				literals, names = tokenize(out)
+				if not names:
+					self.tails.append((True, normpath(out)))
+					continue
+				tail = literals[-1].rstrip('/')
+				while tail.endswith('/.'):
+					tail = tail[:-2].rstrip('/')
+				tail = tail.rpartition('/')[2]
+				if tail in ('', '.'):
+					self.tails = [(False, '')]
+					break
+				self.tails.append((False, tail))
+
+		for exact, tail in self.tails:
+			if path == tail if exact else path.endswith(tail):
+				return True
+		return False
 
 	def genJobs(self, gfiles, gvars):
 		""" The "main" function of Generator is genJobs. It produces a list of
@@ -846,77 +3689,64 @@ class Generator:
 
 		Parameters
 		----------
-		gfiles : (modified) dict, {filename: File}
+		gfiles : (modified) FileIndex or dict, {filename: File}
 			global dictionary of files, will be updated with any new files found
 		gvars : dict {varname: [value...] }
 			global variables used to look up values
 
 		"""
-		# produce all the Jobs from inputs/outputs
-		jobs = list()
-
-		# store array of REAL output paths
-		outputs = [self.outputs]
-
-		# store array of dictionaries that produced output paths, so that the
-		# same variables to be reused for inputs
-		valreal = [dict()]
-		outputs, valreal = expand_variables(self.outputs, dict(), gvars)
-		if VERBOSE > 5:
-			print('============ Generating Jobs From =============')
-			print(self.outputs, self.inputs, self.cmds, outputs, valreal)
-			print("Creating...")
-
-		# now that we have expanded the outputs, just need to expand input
-		# and create a job to store each realization of the expansion process
-		for curouts, curvars in zip(outputs, valreal):
+		jobs = list(self.iterJobs(gfiles, gvars))
+		if log.isEnabledFor(TRACE):
+			log.log(TRACE, "New Jobs%s", "".join(str(j) for j in jobs))
+		return jobs
+
+	def iterJobs(self, gfiles, gvars):
+		""" Generates the Jobs of genJobs() one at a time, updating gfiles
+		as it goes """
+		templates = [CommandTemplate(c) for c in self.cmds]
+
+		log.log(TRACE, "Generating Jobs From %s:%s %s", self.outputs,
+				self.inputs, self.cmds)
+
+		# expand the outputs, each realization of the output variables (and
+		# the dictionary of values that produced it, so that the same values
+		# are reused for inputs) is one job
+		for curouts, curvars in expand_variables(self.outputs, dict(), gvars):
 			# for each input, fill in variable values from outputs
-			curins,trash = expand_variables(self.inputs, curvars, gvars)
-			tmp = []
-			for curin in curins:
-				tmp.extend(curin)
-			curins = tmp
-
-			# insert finalized invals into curins
-			if self.cmds:
-				cmds = resolve_variables(self.cmds, curvars, gvars)
-			else:
-				cmds = []
+			curins = []
+			for curin, trash in expand_variables(self.inputs, curvars, gvars):
+				curins.extend(curin)
 
 			# change curins to list of Files, instead of strings by
 			# finding inputs and outputs in the global files database, and then
 			# pass them in as a list to the new job
 			for ii, name in enumerate(curins):
-				name = str(Path(name))
-				if name in gfiles:
-					curins[ii] = gfiles[name]
-				else:
+				name = normpath(name)
+				f = gfiles.get(name)
+				if f is None:
 					# since the file doesn't exist yet, create as placeholder
-					curins[ii] = File(name)
-					gfiles[name] = curins[ii]
+					f = gfiles[name] = File(name, False)
+				curins[ii] = f
 
 			# find outputs (checking for double-producing is done in Job, below)
 			for ii, name in enumerate(curouts):
-				name = str(Path(name))
-				if name in gfiles:
-					curouts[ii] = gfiles[name]
-				else:
-					curouts[ii] = File(name)
-					gfiles[name] = curouts[ii]
+				name = normpath(name)
+				f = gfiles.get(name)
+				if f is None:
+					f = gfiles[name] = File(name, False)
+				curouts[ii] = f
+
+			# render the commands with the variables, inputs and outputs of
+			# this realization
+			inpaths = [f.path for f in curins]
+			outpaths = [f.path for f in curouts]
+			cmds = [t.render(inpaths, outpaths, curvars, gvars)
+					for t in templates]
 
 			# append Job to list of jobs
 			newjob = Job(curins, curouts, cmds, self)
-			if VERBOSE > 2: print("New Job:%s"% str(newjob))
-
-			# append job to list of jobs
-			jobs.append(newjob)
-
-		# find external files referenced as inputs
-		if VERBOSE > 5:
-			print("New Jobs")
-			for j in jobs:
-				print(j)
-		return jobs
+			log.log(TRACE, "New Job:%s", newjob)
+			yield newjob
 
 	def __str__(self):
 		tmp = "Generator"
@@ -939,21 +3769,29 @@ class Job:
 	# subj = 1 2 3
 	# /ello : /hello/${subj} /world
 	# inputs = [[/hello/1,/hello/2,/hello/3],[/world]]
-	inputs = list() #list of input files   (File)
-	outputs = list() #list of output files (File)
-	cmds = []
-	parent = None
-	pid = None
-	status = None
-	cmdqueue = [] # list of jobs that still need to be run
-
-	# WAITING/RUNNING/SUCCESS/FAIL/DEPFAIL
-	status = 'WAITING'
+	__slots__ = (
+		'inputs',      # tuple of input files   (File)
+		'outputs',     # tuple of output files (File)
+		'cmds',
+		'parent',      # Generator
+		'pid',         # executor handle of the running command
+		'status',      # WAITING/RUNNING/SUCCESS/FAIL/DEPFAIL
+		'cmdqueue',    # list of commands that still need to be run
+		'running_cmd', # command (argument list) being run
+		'nwait',       # number of unfinished upstream jobs (see Scheduler)
+		'priority',    # estimated seconds from its start to the end of the run
+	)
 
 	def __init__(self, inputs, outputs, cmds, parent = None):
-		self.inputs = inputs
-		self.outputs = outputs
+		self.inputs = tuple(inputs)
+		self.outputs = tuple(outputs)
 		self.parent = parent
+		self.pid = None
+		self.status = 'WAITING'
+		self.cmdqueue = None
+		self.running_cmd = None
+		self.nwait = 0
+		self.priority = 0
 
 		if "".join(cmds) != "":
 			self.cmds = cmds
@@ -969,8 +3807,26 @@ class Job:
 
 		# add ourself to the list of users of the inputs
 		for ff in self.inputs:
-			ff.users.append(self)
-
+			if ff.users:
+				ff.users.append(self)
+			else:
+				ff.users = [self]
+
+
+	def signature(self):
+		""" Hash of the commands of the job and the paths and fingerprints
+		of its inputs. If it hasn't changed since the job last succeeded,
+		neither would its outputs. """
+		h = hashlib.md5()
+		for cmd in self.cmds:
+			h.update(cmd.encode())
+			h.update(b'\0')
+		for f in self.inputs:
+			h.update(f.path.encode())
+			h.update(b'\0')
+			h.update((f.md5sum or '').encode())
+			h.update(b'\0')
+		return h.hexdigest()
 
 	def __str__(self):
 		out = "\n-----------------------------------------------\n"
@@ -994,5 +3850,13 @@ class Job:
 		out = out + '\n'
 		return out
 
+class Done:
+	""" Stands in, as File.genr, for a Job that succeeded and has been let
+	go of (see Ent.forget) """
+	__slots__ = ()
+	status = 'SUCCESS'
+
+DONE = Done()
+
 if __name__ == "__main__":
-	main()
+	sys.exit(main())
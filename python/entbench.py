@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+"""
+Benchmarks for ent on synthetic trees, so that changes to the parsing,
+expansion, fingerprinting and scheduling code can be measured. Each
+benchmark prints the best time out of --repeat runs.
+
+	entbench.py expand --subjects 1000 --vars 5
+	entbench.py parse schedule --shape deep --depth 50
+
+Trees (see synthetic_tree) come in several shapes:
+	wide      - one job fanning out to a job per subject, gathered by one job
+	deep      - a chain of --depth jobs per subject
+	vars      - paths built from --vars nested variables
+	dependent - paths using a dependent variable, SESS[SUBJ]
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ent
+
+SHAPES = ['wide', 'deep', 'vars', 'dependent']
+
+def timeit(name, func, repeat, setup = None):
+	""" Runs func repeat times and prints the best wall time. If setup is
+	given it is called (untimed) before each run and its result is passed to
+	func """
+	best = None
+	for ii in range(repeat):
+		with open(os.devnull, "w") as devnull:
+			with contextlib.redirect_stdout(devnull):
+				if setup is None:
+					start = time.perf_counter()
+					result = func()
+				else:
+					arg = setup()
+					start = time.perf_counter()
+					result = func(arg)
+				elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	print("%-32s %10.4fs" % (name, best))
+	return result
+
+def synthetic_variables(nsubjects, nvars):
+	""" Variables for a tree with nsubjects subjects and nvars variables per
+	path: SUBJ, a dependent SESS[SUBJ] and nested single valued variables
+	(DIR1 = ${BASE}/x1, DIR2 = ${DIR1}/x2 ...) """
+	gvars = {'.PWD' : os.getcwd(), 'BASE' : ['/data']}
+	gvars['SUBJ'] = ['sub%05i' % ii for ii in range(nsubjects)]
+	gvars['SESS'] = (['ses%05i' % ii for ii in range(nsubjects)], 'SUBJ')
+	prev = 'BASE'
+	for ii in range(1, max(nvars - 2, 1) + 1):
+		gvars['DIR%i' % ii] = ['${%s}/x%i' % (prev, ii)]
+		prev = 'DIR%i' % ii
+	ent.link_variables(gvars)
+	return gvars, prev
+
+def synthetic_tree(shape, args, base = '/data'):
+	""" A tree of the given shape (one of SHAPES) in the JSON format read by
+	ent.parseV2, {"variables": {...}, "generators": [...]}. Paths are under
+	base. """
+	subjects = ['sub%05i' % ii for ii in range(args.subjects)]
+	variables = {'BASE' : base, 'SUBJ' : subjects}
+	generators = []
+	def gen(outputs, inputs, *cmds):
+		generators.append({'inputs' : inputs, 'outputs' : outputs,
+				'commands' : list(cmds)})
+
+	if shape == 'wide':
+		gen(['${BASE}/root'], [], 'touch $>')
+		gen(['${BASE}/${SUBJ}/a'], ['${BASE}/root'], 'cp $< $>')
+		gen(['${BASE}/${SUBJ}/b'], ['${BASE}/${SUBJ}/a'], 'cp $< $>',
+				'touch $>')
+		gen(['${BASE}/all'], ['${BASE}/${SUBJ}/b'], 'cat $< > $>')
+	elif shape == 'deep':
+		gen(['${BASE}/${SUBJ}/s0'], [], 'touch $>')
+		for ii in range(1, args.depth):
+			gen(['${BASE}/${SUBJ}/s%i' % ii], ['${BASE}/${SUBJ}/s%i' %
+				(ii-1)], 'cp $< $>')
+	elif shape == 'vars':
+		prev = 'BASE'
+		for ii in range(1, max(args.vars - 1, 1) + 1):
+			variables['DIR%i' % ii] = '${%s}/x%i' % (prev, ii)
+			prev = 'DIR%i' % ii
+		gen(['${%s}/${SUBJ}/in' % prev], [], 'touch $>')
+		gen(['${%s}/${SUBJ}/out' % prev, '${%s}/${SUBJ}/out.txt' % prev],
+				['${%s}/${SUBJ}/in' % prev, '${BASE}/atlas'],
+				'process -i ${<0} -a ${<1} -o ${>0} -t ${>1} -s ${SUBJ}')
+		gen(['${BASE}/atlas'], [], 'touch $>')
+	elif shape == 'dependent':
+		variables['SESS[SUBJ]'] = ['ses%05i' % ii for ii in
+				range(args.subjects)]
+		variables['SUBDIR'] = '${BASE}/${SUBJ}/${SESS}'
+		gen(['${SUBDIR}/in'], [], 'touch $>')
+		gen(['${SUBDIR}/out'], ['${SUBDIR}/in'], 'cp $< $> ${SESS}')
+		gen(['${BASE}/${SESS}.txt'], ['${SUBDIR}/out'], 'cp $< $>')
+	else:
+		raise ValueError("unknown shape %s" % shape)
+
+	return {'variables' : variables, 'generators' : generators}
+
+def write_tree(tree, prefix):
+	""" Writes tree (see synthetic_tree) as prefix.json and prefix.ent,
+	returns the two file names """
+	with open(prefix + '.json', "w") as f:
+		json.dump(tree, f, indent=1)
+
+	with open(prefix + '.ent', "w") as f:
+		for name, value in tree['variables'].items():
+			if type(value) != type([]):
+				value = [value]
+			f.write("%s = %s\n" % (name, " ".join(value)))
+		for g in tree['generators']:
+			f.write("\n%s: %s\n" % (" ".join(g['outputs']),
+				" ".join(g['inputs'])))
+			for cmd in g['commands']:
+				f.write("\t%s\n" % cmd)
+		f.write("\n")
+	return prefix + '.json', prefix + '.ent'
+
+@contextlib.contextmanager
+def scratch():
+	""" A temporary directory, removed afterwards """
+	tmpdir = tempfile.mkdtemp(prefix='entbench')
+	try:
+		yield tmpdir
+	finally:
+		shutil.rmtree(tmpdir)
+
+def expand_all(geners, gvars):
+	""" Expands every Generator, returns (jobs, files) """
+	files = dict()
+	jobs = []
+	for gen in geners:
+		jobs.extend(gen.genJobs(files, gvars))
+	return jobs, files
+
+def bench_parse(args):
+	""" parseV1 and parseV2 of the same tree """
+	with scratch() as tmpdir:
+		jsonfile, entfile = write_tree(synthetic_tree(args.shape, args),
+				os.path.join(tmpdir, args.shape))
+		timeit("parseV1 (%s)" % args.shape, lambda: ent.parseV1(entfile),
+				args.repeat)
+		timeit("parseV2 (%s)" % args.shape, lambda: ent.parseV2(jsonfile),
+				args.repeat)
+
+def bench_expand(args):
+	gvars, last = synthetic_variables(args.subjects, args.vars)
+	outputs = ['${%s}/${SUBJ}/${SESS}/out.nii.gz' % last,
+			'${%s}/${SUBJ}/${SESS}/out.txt' % last]
+	inputs = ['${%s}/${SUBJ}/${SESS}/in.nii.gz' % last, '${BASE}/atlas']
+
+	real = timeit("expand_variables", lambda: list(
+			ent.expand_variables(outputs, dict(), gvars)), args.repeat)
+	print("%-32s %10i" % ("realizations", len(real)))
+
+	gen = ent.Generator(inputs, outputs)
+	gen.cmds = ['process -i ${<0} -a ${<1} -o ${>0} -t ${>1} -s ${SUBJ}']
+	jobs = timeit("Generator.genJobs", lambda: gen.genJobs(dict(), gvars),
+			args.repeat)
+	print("%-32s %10i" % ("jobs", len(jobs)))
+
+def bench_genjobs(args):
+	""" Generator.genJobs of every Generator of a tree """
+	with scratch() as tmpdir:
+		jsonfile, entfile = write_tree(synthetic_tree(args.shape, args),
+				os.path.join(tmpdir, args.shape))
+		geners, gvars = ent.parseV2(jsonfile)
+	jobs, files = timeit("genJobs (%s)" % args.shape,
+			lambda: expand_all(geners, gvars), args.repeat)
+	print("%-32s %10i" % ("jobs", len(jobs)))
+	print("%-32s %10i" % ("files", len(files)))
+
+def bench_scan(args):
+	""" scan_files of --files files spread over --subjects directories, in
+	each fingerprint mode, then md5 again with a warm FingerprintCache """
+	with scratch() as tmpdir:
+		paths = []
+		ndirs = max(min(args.subjects, args.files), 1)
+		for ii in range(ndirs):
+			os.mkdir(os.path.join(tmpdir, 'd%05i' % ii))
+		block = os.urandom(args.filesize)
+		for ii in range(args.files):
+			path = os.path.join(tmpdir, 'd%05i' % (ii % ndirs), 'f%07i' % ii)
+			with open(path, "wb") as f:
+				f.write(block)
+			paths.append(path)
+
+		for mode in ent.FINGERPRINTS:
+			timeit("scan_files (%s)" % mode, lambda: ent.scan_files(paths,
+					mode, None, args.threads), args.repeat)
+
+		cache = ent.FingerprintCache()
+		ent.scan_files(paths, 'md5', cache, args.threads)
+		timeit("scan_files (md5, cached)", lambda: ent.scan_files(paths,
+				'md5', cache, args.threads), args.repeat)
+	print("%-32s %10i" % ("files", len(paths)))
+
+class MockExecutor(ent.Executor):
+	""" Executor whose commands finish, successfully, as soon as they are
+	submitted """
+
+	def __init__(self):
+		self.done = []
+		self.count = 0
+		self.submitted = 0
+
+	def submit(self, cmd):
+		self.count += 1
+		self.submitted += 1
+		self.done.append((self.count, 0))
+		return self.count
+
+	def wait(self, timeout = None):
+		return self.done.pop(0) if self.done else None
+
+	def harvest(self, timeout = None):
+		done = self.done
+		self.done = []
+		return done
+
+def bench_schedule(args):
+	""" Ent.run of a whole tree (nothing up to date) with MockExecutor, in
+	commands per second """
+	with scratch() as tmpdir:
+		jsonfile, entfile = write_tree(synthetic_tree(args.shape, args,
+				os.path.join(tmpdir, 'out')), os.path.join(tmpdir, args.shape))
+		def setup():
+			return ent.Ent(jsonfile, treecache = None), MockExecutor()
+		def run(arg):
+			entobj, executor = arg
+			entobj.run(executor)
+			return executor
+		executor = timeit("Ent.run (%s)" % args.shape, run, args.repeat,
+				setup)
+
+		entobj, executor = setup()
+		start = time.perf_counter()
+		run((entobj, executor))
+		elapsed = time.perf_counter() - start
+	print("%-32s %10i" % ("commands", executor.submitted))
+	print("%-32s %10.0f" % ("commands per second",
+			executor.submitted / elapsed))
+
+def objsize(obj):
+	""" Size of obj including its instance dict, if it has one """
+	size = sys.getsizeof(obj)
+	if hasattr(obj, '__dict__'):
+		size += sys.getsizeof(obj.__dict__)
+	return size
+
+def bench_memory(args):
+	""" Bytes allocated per Job and per File by Generator.genJobs, including
+	paths and commands """
+	gvars, last = synthetic_variables(args.subjects, args.vars)
+	outputs = ['${%s}/${SUBJ}/${SESS}/out.nii.gz' % last,
+			'${%s}/${SUBJ}/${SESS}/out.txt' % last]
+	inputs = ['${%s}/${SUBJ}/${SESS}/in.nii.gz' % last, '${BASE}/atlas']
+	gen = ent.Generator(inputs, outputs)
+	gen.cmds = ['process -i ${<0} -a ${<1} -o ${>0} -t ${>1} -s ${SUBJ}']
+
+	files = dict()
+	with open(os.devnull, "w") as devnull:
+		with contextlib.redirect_stdout(devnull):
+			tracemalloc.start()
+			before = tracemalloc.get_traced_memory()[0]
+			jobs = gen.genJobs(files, gvars)
+			after = tracemalloc.get_traced_memory()[0]
+			tracemalloc.stop()
+
+	jobbytes = sum(objsize(j) + sys.getsizeof(j.inputs) +
+			sys.getsizeof(j.outputs) + sys.getsizeof(j.cmds) +
+			sum(sys.getsizeof(c) for c in j.cmds) for j in jobs)
+	filebytes = sum(objsize(f) + sys.getsizeof(f.name) +
+			sys.getsizeof(f.users) for f in files.values())
+	print("%-32s %10i" % ("jobs", len(jobs)))
+	print("%-32s %10i" % ("files", len(files)))
+	print("%-32s %10.1f" % ("bytes per job", jobbytes / len(jobs)))
+	print("%-32s %10.1f" % ("bytes per file", filebytes / len(files)))
+	print("%-32s %10.1f" % ("total bytes per job", (after - before) /
+			len(jobs)))
+
+BENCHMARKS = {
+	'parse' : bench_parse,
+	'expand' : bench_expand,
+	'genjobs' : bench_genjobs,
+	'scan' : bench_scan,
+	'schedule' : bench_schedule,
+	'memory' : bench_memory,
+}
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark ENT')
+	parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+			help='Benchmarks to run (default: all of %s)' % sorted(BENCHMARKS))
+	parser.add_argument('--shape', type=str, default=None, choices=SHAPES,
+			help='Shape of the synthetic tree for parse, genjobs and '
+			'schedule (default: each of them)')
+	parser.add_argument('--subjects', type=int, default=1000,
+			help='Number of values of the subject variable')
+	parser.add_argument('--vars', type=int, default=5,
+			help='Number of variables referenced by each path')
+	parser.add_argument('--depth', type=int, default=10,
+			help='Length of the chain of jobs per subject (deep shape)')
+	parser.add_argument('--files', type=int, default=10000,
+			help='Number of files to fingerprint (scan)')
+	parser.add_argument('--filesize', type=int, default=4096,
+			help='Size of the files to fingerprint (scan)')
+	parser.add_argument('--threads', type=int, default=None,
+			help='Threads used to fingerprint files (scan)')
+	parser.add_argument('--repeat', type=int, default=3,
+			help='Number of times to run each benchmark')
+	args = parser.parse_args()
+	ent.log.setLevel(logging.ERROR)
+
+	for name in args.benchmarks or sorted(BENCHMARKS):
+		if name not in BENCHMARKS:
+			parser.error("unknown benchmark %s" % name)
+
+	shapes = [args.shape] if args.shape else SHAPES
+	for name in args.benchmarks or sorted(BENCHMARKS):
+		print("== %s ==" % name)
+		if name in ('parse', 'genjobs', 'schedule'):
+			for shape in shapes:
+				args.shape = shape
+				BENCHMARKS[name](args)
+			args.shape = None if len(shapes) > 1 else shapes[0]
+		else:
+			BENCHMARKS[name](args)
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,540 @@
+"""
+Tests of ent, run with: python -m pytest python
+"""
+
+import asyncio
+import collections
+import io
+import json
+import os
+import pathlib
+import queue
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ent
+
+###############################################################################
+# Helpers
+###############################################################################
+
+# Rules are listed consumer first, as in a makefile, so that in lazy mode the
+# jobs making the inputs of a job are expanded after it. Each command appends
+# its name to log, so the test can tell how often it ran.
+CONSUMER_FIRST = """\
+D = {d}
+S = x y z
+
+${{D}}/all: ${{D}}/x.c ${{D}}/y.c ${{D}}/z.c ${{D}}/x.b
+	sh -c "echo all >> ${{D}}/log; cat $< > $>"
+
+${{D}}/${{S}}.c: ${{D}}/${{S}}.b
+	sh -c "echo ${{S}}.c >> ${{D}}/log; cat $< > $>"
+
+${{D}}/${{S}}.b: ${{D}}/${{S}}.a
+	sh -c "echo ${{S}}.b >> ${{D}}/log; cat $< > $>"
+
+${{D}}/${{S}}.a: ${{D}}/src
+	sh -c "echo ${{S}}.a >> ${{D}}/log; cat $< > $>"
+
+${{D}}/src:
+	sh -c "echo src >> ${{D}}/log; echo {value} > $>"
+"""
+
+ALL_COMMANDS = ['all', 'src'] + ['%s.%s' % (s, x) for s in 'xyz'
+		for x in 'abc']
+
+def write_tree(tmp_path, text, **fields):
+	script = tmp_path / 'tree.ent'
+	script.write_text(text.format(d = tmp_path / 'out', **fields))
+	(tmp_path / 'out').mkdir(exist_ok = True)
+	return str(script)
+
+def run_tree(tmp_path, script, lazy, **kwargs):
+	""" Run script with a LocalExecutor, returns the Ent and the Counter of
+	the names commands wrote to out/log """
+	log = tmp_path / 'out' / 'log'
+	log.write_text('')
+	tree = ent.Ent(script, str(tmp_path / 'state.db'), 'md5', lazy = lazy,
+			**kwargs)
+	tree.run(ent.LocalExecutor(2))
+	return tree, collections.Counter(log.read_text().split())
+
+@pytest.fixture
+def small_batches(monkeypatch, tmp_path):
+	""" Expand lazily one job at a time, so that every job is in a batch
+	of its own """
+	monkeypatch.setattr(ent, 'LAZYBATCH', 1)
+	monkeypatch.setattr(ent, 'LAZYWINDOW', 1)
+	monkeypatch.setattr(ent, 'WORKDIR', str(tmp_path / 'work'))
+
+###############################################################################
+# Parsing
+###############################################################################
+
+@pytest.mark.parametrize('path', ['a', 'a/b', '/a//b/', './a/./b', 'a/..',
+	'../a', '/', '//', '///a', '//a/b', '.', './', 'a/b/.', '/./a'])
+def test_normpath_matches_pathlib(path):
+	assert ent.normpath(path) == str(pathlib.PurePosixPath(path))
+
+@pytest.mark.parametrize('path', ['/', '//', '.', '..', '/a', '//a', 'a',
+	'a/b', '/a/b/c', '../x'])
+def test_split_path_matches_os(path):
+	assert ent.split_path(path) == os.path.split(path)
+
+DOCUMENT = {
+	'variables' : {'SUBJ' : ['s1', 's2'], 'N' : 12.5e-3, 'EMPTY' : [],
+		'TEXT' : 'quote " and \\ and \u00e9 and \ud83d\ude00'},
+	'generators' : [
+		{'inputs' : ['in/${SUBJ}.txt'], 'outputs' : 'out/${SUBJ}.txt',
+			'commands' : ['cp ${<0} ${>0}'], 'runtime' : 10, 'limit' : 2},
+		{'inputs' : [], 'outputs' : ['x'], 'commands' : 'touch x',
+			'extra' : [None, True, False, -1, 1e10, {}, [[]]]},
+	],
+	'ignored' : {'a' : [1, 2, {'b' : None}]},
+}
+
+@pytest.mark.parametrize('blocksize', [1, 2, 3, 7, 64, 1 << 20])
+@pytest.mark.parametrize('indent', [None, 1])
+def test_json_stream_matches_json(blocksize, indent):
+	text = json.dumps(DOCUMENT, indent = indent)
+	stream = ent.JsonStream(io.StringIO(text), blocksize)
+	out = {}
+	for key in stream.members():
+		if key == 'generators':
+			out[key] = [stream.value() for ii in stream.items()]
+		else:
+			out[key] = stream.value()
+	assert out == json.loads(text)
+	assert stream.peek() == ''
+
+@pytest.mark.parametrize('text', ['{"a" 1}', '{"a": [1, 2}', '[1]',
+	'{"a": 1,}', '{"a": tru}'])
+def test_json_stream_errors(text):
+	stream = ent.JsonStream(io.StringIO(text), 2)
+	with pytest.raises(json.JSONDecodeError):
+		for key in stream.members():
+			stream.value()
+
+def test_parse_v2(tmp_path):
+	script = tmp_path / 'tree.json'
+	script.write_text(json.dumps(DOCUMENT))
+	geners, variables = ent.parseV2(str(script))
+	assert variables['SUBJ'] == ['s1', 's2']
+	assert [g.outputs for g in geners] == [['out/${SUBJ}.txt'], ['x']]
+	assert [g.cmds for g in geners] == [['cp ${<0} ${>0}'], ['touch x']]
+	assert (geners[0].runtime, geners[0].limit) == (10, 2)
+
+def test_parse_v2_missing_section(tmp_path):
+	script = tmp_path / 'tree.json'
+	script.write_text('{"variables": {}}')
+	with pytest.raises(ent.InputError):
+		ent.parseV2(str(script))
+
+###############################################################################
+# Files
+###############################################################################
+
+def test_file_index():
+	paths = ['/a/b/c', '/a', '/x/y', '//z', 'a/b', '.', 'b', '../q', '/']
+	index = ent.FileIndex()
+	for path in paths:
+		index.add(ent.File(path, False))
+	assert list(index) == paths
+	assert [f.fid for f in index.values()] == list(range(len(paths)))
+	assert index['/a/b/c'].path == '/a/b/c'
+	assert '/a/b' not in index and index.get('/a/b') is None
+	assert index.lookup('/a/./b/') is index['/a/b']
+	assert sorted(f.path for f in index.under('/a')) == ['/a', '/a/b',
+			'/a/b/c']
+	assert sorted(f.path for f in index.under('.')) == ['.', '../q', 'a/b',
+			'b']
+	bydir = index.bydir()
+	assert bydir['/a/b'] == {'c' : '/a/b/c'}
+	assert bydir['/'] == {'a' : '/a', '' : '/'}
+	assert bydir[''] == {'.' : '.', 'b' : 'b'}
+	assert index.bydir({index['b']}) == {'' : {'b' : 'b'}}
+
+def test_tree_cache(tmp_path):
+	text = CONSUMER_FIRST.format(d = tmp_path / 'out', value = 1)
+	script = tmp_path / 'tree.ent'
+	script.write_text(text)
+	tree = ent.Ent(str(script))
+	cache = str(tmp_path / 'tree.marshal')
+	ent.save_tree(cache, 'key', tree.geners, tree.variables, tree.jobs,
+			tree.files)
+	assert ent.load_tree(cache, 'other') is None
+	geners, variables, jobs, files = ent.load_tree(cache, 'key')
+	assert list(files) == list(tree.files)
+	assert [j.cmds for j in jobs] == [j.cmds for j in tree.jobs]
+	assert [[f.path for f in j.inputs] for j in jobs] == \
+			[[f.path for f in j.inputs] for j in tree.jobs]
+	assert all(files[f.path] is f for j in jobs for f in j.outputs)
+
+def test_tree_cache_not_written_readonly(tmp_path):
+	script = write_tree(tmp_path, CONSUMER_FIRST, value = 1)
+	cachedir = tmp_path / 'trees'
+	tree = ent.Ent(script, treecache = str(cachedir), readonly = True)
+	assert len(tree.jobs) == len(ALL_COMMANDS)
+	assert not cachedir.exists()
+	tree = ent.Ent(script, treecache = str(cachedir))
+	assert [p.name for p in cachedir.iterdir()] == \
+			[os.path.basename(ent.tree_file(str(cachedir), script))]
+	again = ent.Ent(script, treecache = str(cachedir), readonly = True)
+	assert [j.cmds for j in again.jobs] == [j.cmds for j in tree.jobs]
+
+###############################################################################
+# State
+###############################################################################
+
+@pytest.mark.parametrize('name', ['state.db', 'state.json'])
+def test_state_store(tmp_path, name):
+	store = ent.openState(str(tmp_path / name))
+	store.save({'a' : '1', 'b' : '2'})
+	store.close()
+	store = ent.openState(str(tmp_path / name))
+	assert store.load() == {'a' : '1', 'b' : '2'}
+	store.close()
+
+def test_sqlite_state_store(tmp_path):
+	job = make_job([], ['out/a', 'out/b'])
+	store = ent.openState(str(tmp_path / 'state.db'))
+	store.save({'out/a' : '1', 'out/b' : '2', 'in' : '3'})
+	store.started([job])
+	assert store.load() == {'in' : '3'}
+	store.finished(job, {'out/a' : '4', 'out/b' : '5'}, 'sig', 2.5)
+	store.failed(make_job([], ['out/c']))
+	store.close()
+
+	store = ent.openState(str(tmp_path / 'state.db'))
+	assert store.load() == {'in' : '3', 'out/a' : '4', 'out/b' : '5'}
+	assert store.signatures() == {'out/a' : 'sig'}
+	assert store.runtimes() == {'out/a' : 2.5}
+	store.close()
+
+def test_json_state_converted(tmp_path):
+	name = str(tmp_path / 'state')
+	with open(name, 'w') as f:
+		json.dump({'a' : '1'}, f)
+	store = ent.openState(name)
+	assert type(store) == ent.SqliteStateStore
+	assert store.load() == {'a' : '1'}
+	store.close()
+
+def test_invalid_state_refused(tmp_path):
+	name = str(tmp_path / 'state')
+	with open(name, 'w') as f:
+		f.write('not a state file')
+	for readonly in (False, True):
+		with pytest.raises(ent.InputError):
+			ent.openState(name, readonly)
+	assert open(name).read() == 'not a state file'
+
+def test_readonly_state(tmp_path):
+	name = str(tmp_path / 'state')
+	store = ent.openState(name, True)
+	assert store.load() == {}
+	assert not os.path.exists(name)
+
+	with open(name, 'w') as f:
+		json.dump({'a' : '1'}, f)
+	store = ent.openState(name, True)
+	assert store.load() == {'a' : '1'}
+	with open(name) as f:
+		assert json.load(f) == {'a' : '1'}
+
+	ent.openState(name).close()
+	store = ent.openState(name, True)
+	assert store.load() == {'a' : '1'}
+	store.close()
+
+###############################################################################
+# Executors
+###############################################################################
+
+def test_local_executor():
+	executor = ent.LocalExecutor(2)
+	executor.start()
+	try:
+		ok = executor.submit(['true'])
+		bad = executor.submit(['sh', '-c', 'exit 3'])
+		missing = executor.submit(['/nonexistent/command'])
+		done = dict()
+		while len(done) < 3:
+			done.update(executor.harvest(10))
+		assert done == {ok : 0, bad : 3, missing : 127}
+		usage = executor.resources(ok)
+		assert usage['finished'] >= usage['started']
+		assert executor.resources(ok) == {}
+		assert executor.harvest(0) == []
+	finally:
+		executor.stop()
+
+def test_local_executor_reports_crashes(monkeypatch):
+	def crash(cmd):
+		raise RuntimeError("crash")
+	monkeypatch.setattr(ent.LocalExecutor, 'call', staticmethod(crash))
+	executor = ent.LocalExecutor(1)
+	executor.start()
+	try:
+		handle = executor.submit(['true'])
+		done = dict()
+		deadline = time.time() + 10
+		while not done and time.time() < deadline:
+			done.update(executor.harvest(1))
+		assert done == {handle : 127}
+	finally:
+		executor.stop()
+
+class QueueExecutor(ent.Executor):
+	""" Executor implementing only wait(), on a queue of finished commands """
+	def __init__(self):
+		self.done = queue.Queue()
+
+	def wait(self, timeout = None):
+		try:
+			return self.done.get(timeout = timeout)
+		except queue.Empty:
+			return None
+
+def test_harvest_honours_timeout():
+	executor = QueueExecutor()
+	started = time.time()
+	assert executor.harvest(0.1) == []
+	assert time.time() - started < 5
+	executor.done.put((1, 0))
+	executor.done.put((2, 1))
+	assert executor.harvest(0) == [(1, 0), (2, 1)]
+
+###############################################################################
+# Lazy expansion
+###############################################################################
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_consumer_first_runs_each_command_once(tmp_path, small_batches, lazy):
+	script = write_tree(tmp_path, CONSUMER_FIRST, value = 1)
+	tree, counts = run_tree(tmp_path, script, lazy)
+	assert counts == collections.Counter(ALL_COMMANDS)
+	assert (tmp_path / 'out' / 'all').read_text() == '1\n' * 4
+
+	# everything downstream of src is made again, once
+	script = write_tree(tmp_path, CONSUMER_FIRST, value = 2)
+	tree, counts = run_tree(tmp_path, script, lazy)
+	assert counts == collections.Counter(ALL_COMMANDS)
+	assert (tmp_path / 'out' / 'all').read_text() == '2\n' * 4
+
+	# and nothing when it is up to date
+	tree, counts = run_tree(tmp_path, script, lazy)
+	assert counts == collections.Counter()
+
+CYCLE = """\
+{d}/a: {d}/b
+	sh -c "echo a >> {d}/log; touch $>"
+
+{d}/b: {d}/a
+	sh -c "echo b >> {d}/log; touch $>"
+
+{d}/c:
+	sh -c "echo c >> {d}/log; touch $>"
+"""
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_cycle_is_an_error(tmp_path, small_batches, lazy):
+	script = write_tree(tmp_path, CYCLE)
+	(tmp_path / 'out' / 'log').write_text('')
+	tree = ent.Ent(script, str(tmp_path / 'state.db'), lazy = lazy)
+	with pytest.raises(ent.InputError) as error:
+		tree.run(ent.LocalExecutor(2))
+	assert 'between 2 jobs' in error.value.msg
+	assert (tmp_path / 'out' / 'log').read_text() == 'c\n'
+	assert sorted(f.path for job in tree.stuck() for f in job.outputs) == \
+			[str(tmp_path / 'out' / 'a'), str(tmp_path / 'out' / 'b')]
+
+def test_lazy_status_counts_every_waiting_job(tmp_path):
+	script = write_tree(tmp_path, CONSUMER_FIRST, value = 1)
+	tree = ent.Ent(script, str(tmp_path / 'state.db'), lazy = True)
+	tree.startRun(ent.LocalExecutor(1), False, None)
+	try:
+		while tree.pending:
+			tree.addBatch(next(tree.pending, None))
+		jobs = tree.status()['jobs']
+	finally:
+		tree.stopRun()
+	assert jobs['WAITING'] == len(ALL_COMMANDS)
+	assert jobs['RUNNING'] == 0
+
+@pytest.mark.parametrize('value', [1.5, '2', True, 0, -1, [3]])
+def test_control_limit_must_be_whole(value):
+	tree = ent.Ent.__new__(ent.Ent)
+	tree.maxrunning = 4
+	control = ent.Control(tree, None)
+	control.changed = asyncio.Event()
+	with pytest.raises(ValueError):
+		control.request({'command' : 'limit', 'value' : value})
+	assert tree.maxrunning == 4
+	control.request({'command' : 'limit', 'value' : 2})
+	assert tree.maxrunning == 2
+	control.request({'command' : 'limit', 'value' : None})
+	assert tree.maxrunning is None
+
+class RecordingMaster(ent.Master):
+	""" Master keeping the Ent.maxrunning share() gives each tree """
+	def share(self):
+		ent.Master.share(self)
+		self.shares.append([tree.maxrunning for tree in self.ents])
+
+def test_master_shares_executor_concurrency(tmp_path):
+	trees = []
+	for name in ['one', 'two']:
+		(tmp_path / name).mkdir()
+		script = write_tree(tmp_path / name, CONSUMER_FIRST, value = name)
+		(tmp_path / name / 'out' / 'log').write_text('')
+		trees.append(ent.Ent(script, str(tmp_path / name / 'state.db')))
+	master = RecordingMaster(trees)
+	master.shares = []
+	master.run(ent.LocalExecutor(2))
+	assert master.maxrunning == 2
+	assert master.shares[0] == [1, 1]
+	for name in ['one', 'two']:
+		log = (tmp_path / name / 'out' / 'log').read_text()
+		assert collections.Counter(log.split()) == \
+				collections.Counter(ALL_COMMANDS)
+
+###############################################################################
+# Scheduler
+###############################################################################
+
+def make_job(inputs, outputs, status = 'WAITING'):
+	job = ent.Job([ent.File(f) if type(f) == str else f for f in inputs],
+			[ent.File(f) for f in outputs], ['cmd %s' % ' '.join(outputs)])
+	job.status = status
+	return job
+
+def test_ready_by_priority():
+	jobs = [make_job([], [name]) for name in 'abcd']
+	for job, priority in zip(jobs, [1, 5, 5, 3]):
+		job.priority = priority
+	sched = ent.Scheduler(jobs)
+	assert [sched.pop() for job in jobs] == [jobs[1], jobs[2], jobs[3],
+			jobs[0]]
+	assert sched.pop() is None
+
+def test_runs_after_producers():
+	a = make_job([], ['a'])
+	b = make_job([a.outputs[0]], ['b'])
+	c = make_job([a.outputs[0], b.outputs[0], 'src'], ['c'])
+	sched = ent.Scheduler([c, b, a])
+	assert drain(sched) == [a, b, c]
+	assert sched.unfinished == 0
+
+def test_failure_fails_downstream():
+	a = make_job([], ['a'])
+	b = make_job([a.outputs[0]], ['b'])
+	c = make_job([b.outputs[0]], ['c'])
+	other = make_job([], ['other'])
+	sched = ent.Scheduler([a, b, c, other])
+	job = sched.pop()
+	assert job is a
+	sched.finish(a, False)
+	assert [a.status, b.status, c.status] == ['FAIL', 'DEPFAIL', 'DEPFAIL']
+	assert drain(sched) == [other]
+	assert sched.unfinished == 0
+
+	sched.retry([a, b, c])
+	assert drain(sched) == [a, b, c]
+
+def test_open_scheduler_waits_for_claims():
+	sched = ent.Scheduler()
+	user = make_job(['later'], ['user'])
+	sched.add(user)
+	assert drain(sched) == []
+	make = make_job([], [])
+	make.outputs = user.inputs
+	user.inputs[0].genr = make
+	sched.add(make)
+	assert drain(sched) == [make, user]
+
+	# inputs nobody claims are sources once the scheduler is closed
+	source = make_job(['source'], ['x'])
+	sched.add(source)
+	assert drain(sched) == []
+	sched.close()
+	assert drain(sched) == [source]
+
+def drain(sched):
+	""" Run the ready jobs one at a time until there are none, returns
+	them in the order they ran """
+	order = []
+	while sched.ready:
+		job = sched.pop()
+		if job is None:
+			break
+		job.status = 'RUNNING'
+		order.append(job)
+		sched.finish(job, True)
+	return order
+
+def test_invalidate_consumers_added_first():
+	# all and c are up to date, but b, added after them, isn't
+	b = make_job([], ['b'])
+	c = make_job([b.outputs[0]], ['c'], 'SUCCESS')
+	top = make_job([b.outputs[0], c.outputs[0]], ['all'], 'SUCCESS')
+	b.outputs[0].users = [top, c]
+	sched = ent.Scheduler([top, c, b])
+	assert drain(sched) == [b, c, top]
+	assert sched.unfinished == 0
+
+def test_hold_waits_until_settled():
+	sched = ent.Scheduler()
+	sched.hold = True
+	src = ent.File('src')
+	a = make_job([src], ['a'], 'SUCCESS')
+	user = make_job([a.outputs[0]], ['user'])
+	sched.add(a)
+	sched.add(user)
+	assert drain(sched) == []
+
+	# the job making src, added later, remakes a before user may run
+	make = make_job([], [])
+	make.outputs = (src,)
+	src.genr = make
+	sched.add(make)
+	assert a.status == 'WAITING'
+	assert drain(sched) == [make]
+	sched.settle(make)
+	assert drain(sched) == [a]
+	sched.settle(a)
+	assert drain(sched) == [user]
+
+def test_converted_state_keeps_signatures(tmp_path, small_batches):
+	script = write_tree(tmp_path, CONSUMER_FIRST, value = 1)
+	log = tmp_path / 'out' / 'log'
+	log.write_text('')
+	tree = ent.Ent(script, str(tmp_path / 'state.json'), 'md5')
+	tree.run(ent.LocalExecutor(2))
+	tree.saveState()
+	os.rename(tmp_path / 'state.json', tmp_path / 'state.db')
+
+	# converted, the outputs are trusted once
+	tree, counts = run_tree(tmp_path, script, False)
+	assert tree.state.converted
+	assert counts == collections.Counter()
+
+	# but a changed command is noticed after that
+	script = write_tree(tmp_path, CONSUMER_FIRST, value = 2)
+	tree, counts = run_tree(tmp_path, script, False)
+	assert counts == collections.Counter(ALL_COMMANDS)
+
+def test_missing_signature_is_stale(tmp_path, small_batches):
+	script = write_tree(tmp_path, CONSUMER_FIRST, value = 1)
+	run_tree(tmp_path, script, False)
+	store = ent.SqliteStateStore(str(tmp_path / 'state.db'))
+	with store.db:
+		store.db.execute("UPDATE jobs SET signature = NULL WHERE key LIKE "
+				"'%all'")
+	store.close()
+	tree, counts = run_tree(tmp_path, script, False)
+	assert counts == collections.Counter(['all'])